@@ -0,0 +1,10 @@
+-- Covering indexes for the hot lookups of module_filter.py and routes.py that were
+-- answered by full table scans: topic_id -> module_id for topic filters, topic name ->
+-- topic_id (the rowid) for topic filters and mapping, and prereq_module_id_uni ->
+-- module_id_uni for the previous-modules filter. Indexes that a database already has
+-- under another name (e.g. generated from modules.dbml) are skipped by the runner.
+CREATE INDEX IF NOT EXISTS ix_module_topic_mappings_topic_id ON module_topic_mappings (topic_id, module_id);
+CREATE INDEX IF NOT EXISTS ix_module_topic_mappings_module_id ON module_topic_mappings (module_id, topic_id);
+CREATE INDEX IF NOT EXISTS ix_topics_topic ON topics (topic);
+CREATE INDEX IF NOT EXISTS ix_module_prerequisite_mappings_prereq ON module_prerequisite_mappings (prereq_module_id_uni, module_id_uni);
+CREATE INDEX IF NOT EXISTS ix_module_prerequisite_mappings_module ON module_prerequisite_mappings (module_id_uni, prereq_module_id_uni);
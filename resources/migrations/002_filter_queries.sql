@@ -0,0 +1,10 @@
+-- Filter combinations of the module listings, one row per combination (the normalized
+-- JSON of routes.fetch_unranked_modules' filters) with its request count and the time it
+-- was last requested. The most requested recent ones are replayed on start to warm the
+-- filter cache, see backend/query_history.py.
+CREATE TABLE IF NOT EXISTS filter_queries (
+    filters TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_filter_queries_last_seen ON filter_queries (last_seen, hits);
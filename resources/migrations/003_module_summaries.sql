@@ -0,0 +1,10 @@
+-- Compact ranking summary of every module, written by scripts/10_summarize_modules.py. The
+-- ranking prompt uses the summary instead of the raw description and prerequisites while
+-- content_hash still matches the module texts it was generated from, see
+-- backend/module_summaries.py.
+CREATE TABLE IF NOT EXISTS module_summaries (
+    module_id_uni TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
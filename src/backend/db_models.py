@@ -1,6 +1,6 @@
 import os
 from dotenv import load_dotenv
-from sqlalchemy import Column, Integer, String, ForeignKey, BLOB, create_engine
+from sqlalchemy import Column, Integer, String, ForeignKey, BLOB, Index, create_engine
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
 
 load_dotenv()
@@ -111,6 +111,53 @@ class ModuleTopicMapping(Base):
     topic = relationship("Topic", back_populates="modules")
 
 
+class ModuleServing(Base):
+    """
+    One pre-joined listing row per module with topics, written at ETL time by
+    scripts/08_build_module_serving.py. Lists are comma separated like group_concat.
+    """
+
+    __tablename__ = "module_serving"
+    module_id = Column(Integer, ForeignKey("modules.module_id"), primary_key=True)
+    module_id_uni = Column(String)
+    name = Column(String, nullable=False)
+    description = Column(String)
+    prereq = Column(String)
+    digital_score = Column(Integer)
+    ects = Column(Integer)
+    lang = Column(String)
+    level = Column(String)
+    org_id = Column(String)
+    chair = Column(String)
+    department = Column(String)
+    school = Column(String)
+    school_id = Column(String)
+    department_id = Column(String)
+    topics = Column(String)
+    prereq_modules = Column(String)
+
+    __table_args__ = (
+        Index("ix_module_serving_filters", "level", "lang", "ects", "digital_score"),
+        Index(
+            "ix_module_serving_school",
+            "school_id",
+            "level",
+            "lang",
+            "ects",
+            "digital_score",
+        ),
+        Index(
+            "ix_module_serving_department",
+            "department_id",
+            "level",
+            "lang",
+            "ects",
+            "digital_score",
+        ),
+        Index("ix_module_serving_module_id_uni", "module_id_uni", unique=True),
+    )
+
+
 # Connect to the existing database
 engine = create_engine(f'sqlite:///{os.getenv("DB_PATH")}')
 Base.metadata.create_all(engine)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import struct
+from functools import lru_cache
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from backend.sqlite_cache import SqliteCache
+
+load_dotenv()
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Query embeddings are cached in their own SQLite file next to the database
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DB_PATH", "modules.db"))),
+    "embedding_cache.db",
+)
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 256 * 2**20))
+
+# Binary embedding layout: a fixed header followed by the raw little-endian vector.
+#   magic (4 bytes) | dtype code (uint32) | dimension (uint32) | values
+EMBEDDING_MAGIC = b"EMB1"
+EMBEDDING_HEADER = struct.Struct("<4sII")
+
+# dtype code -> numpy dtype. Only float32 is written, the table leaves room for more.
+EMBEDDING_DTYPES = {1: np.dtype("<f4")}
+EMBEDDING_DTYPE_CODES = {dtype: code for code, dtype in EMBEDDING_DTYPES.items()}
+
+
+def pack_embedding(embedding, dtype="<f4") -> bytes:
+    """Serialises a vector into the binary embedding format."""
+    dtype = np.dtype(dtype)
+    values = np.asarray(embedding, dtype=dtype).ravel()
+    header = EMBEDDING_HEADER.pack(
+        EMBEDDING_MAGIC, EMBEDDING_DTYPE_CODES[dtype], values.shape[0]
+    )
+    return header + values.tobytes()
+
+
+def is_packed(blob) -> bool:
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(
+        blob[: len(EMBEDDING_MAGIC)]
+    ) == bytes(EMBEDDING_MAGIC)
+
+
+def read_header(blob):
+    """Returns (dtype, dimension) of a packed embedding."""
+    magic, dtype_code, dimension = EMBEDDING_HEADER.unpack_from(blob)
+    if magic != EMBEDDING_MAGIC:
+        raise ValueError("Not a packed embedding")
+    return EMBEDDING_DTYPES[dtype_code], dimension
+
+
+def unpack_embedding(blob) -> np.ndarray:
+    """
+    Returns the vector stored in `blob`. Packed embeddings are returned as a read-only
+    view on the buffer (no copy), legacy JSON embeddings are parsed.
+    """
+    if is_packed(blob):
+        dtype, dimension = read_header(blob)
+        return np.frombuffer(
+            blob, dtype=dtype, count=dimension, offset=EMBEDDING_HEADER.size
+        )
+    if isinstance(blob, (bytes, bytearray, memoryview)):
+        blob = bytes(blob).decode()
+    return np.asarray(json.loads(blob), dtype=np.float32)
+
+
+def embeddings_to_matrix(blobs, dimension=None) -> np.ndarray:
+    """
+    Copies a sequence of embeddings into one contiguous float32 matrix of shape (n, dimension).
+    """
+    blobs = list(blobs)
+    if dimension is None:
+        dimension = unpack_embedding(blobs[0]).shape[0] if blobs else 0
+    matrix = np.empty((len(blobs), dimension), dtype=np.float32)
+    for row, blob in enumerate(blobs):
+        vector = unpack_embedding(blob)
+        if vector.shape[0] != dimension:
+            raise ValueError(
+                f"Embedding {row} has dimension {vector.shape[0]}, expected {dimension}"
+            )
+        matrix[row] = vector
+    return matrix
+
+
+@lru_cache(maxsize=None)
+def openai_client():
+    """One shared client, so connections are reused across requests."""
+    return OpenAI()
+
+
+def embed_texts(texts, model=EMBEDDING_MODEL) -> np.ndarray:
+    """Embeds all `texts` with a single embeddings request. Returns a float32 (n, d) matrix."""
+    texts = list(texts)
+    response = openai_client().embeddings.create(model=model, input=texts)
+    data = sorted(response.data, key=lambda item: item.index)
+    return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def embedding_cache():
+    return SqliteCache(
+        EMBEDDING_CACHE_PATH, "embeddings", max_bytes=EMBEDDING_CACHE_MAX_BYTES
+    )
+
+
+def normalize_text(text):
+    return " ".join(text.split()).casefold()
+
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL):
+    return f"{model}:{hashlib.sha256(normalize_text(text).encode()).hexdigest()}"
+
+
+def cached_embed_texts(texts, model=EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Like `embed_texts`, but looks every text up in the persistent embedding cache first.
+    Texts that only differ in case or whitespace share one cache entry. All misses are
+    embedded with a single request and written back to the cache.
+    """
+    texts = list(texts)
+    keys = [embedding_cache_key(text, model=model) for text in texts]
+    cache = embedding_cache()
+    embeddings = {
+        key: unpack_embedding(blob) for key, blob in cache.get_many(keys).items()
+    }
+    missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+    if missing:
+        missing_embeddings = embed_texts(missing.values(), model=model)
+        embeddings.update(zip(missing.keys(), missing_embeddings))
+        cache.set_many(
+            {
+                key: pack_embedding(embedding)
+                for key, embedding in zip(missing.keys(), missing_embeddings)
+            }
+        )
+    return np.stack([embeddings[key] for key in keys])
@@ -0,0 +1,64 @@
+import json
+
+
+class ArrayItemParser:
+    """
+    Incrementally parses a streamed JSON document like {"ranked_modules": [{...}, {...}]}
+    and returns every object (or array) item of its first array as soon as the item is
+    complete, while the rest of the document is still being generated.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        # Next character of the buffer to scan
+        self.position = 0
+        self.depth = 0
+        # Depth inside the first array, None before it starts
+        self.array_depth = None
+        self.array_closed = False
+        self.item_start = None
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """Adds the next chunk of the document. Returns the items the chunk completed."""
+        self.buffer += chunk
+        items = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if char == "[" and self.array_depth is None:
+                    self.array_depth = self.depth
+                elif self._in_array(self.depth - 1):
+                    self.item_start = self.position
+            elif char in "}]":
+                self.depth -= 1
+                if self._in_array(self.depth) and self.item_start is not None:
+                    items.append(
+                        json.loads(self.buffer[self.item_start : self.position + 1])
+                    )
+                    self.item_start = None
+                elif self.array_depth is not None and self.depth < self.array_depth:
+                    self.array_closed = True
+            self.position += 1
+
+        # Only the unfinished item has to be kept
+        start = self.position if self.item_start is None else self.item_start
+        self.buffer = self.buffer[start:]
+        self.position -= start
+        if self.item_start is not None:
+            self.item_start = 0
+        return items
+
+    def _in_array(self, depth):
+        return not self.array_closed and depth == self.array_depth
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """
+    Byte-budgeted LRU cache of bytes values in process memory, with the interface of
+    SqliteCache. The least recently used entries are evicted once the stored values exceed
+    `max_bytes`. With a `shared` cache (e.g. a SqliteCache file all workers use) local misses
+    are looked up there, and new entries are written to both.
+    Hit and miss counters count local lookups only.
+    """
+
+    def __init__(self, max_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns {key: value} for all keys that are cached."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            shared = self.shared.get_many(missing)
+            self._store(shared)
+            found.update(shared)
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        self._store(items)
+        if self.shared is not None:
+            self.shared.set_many(items)
+
+    def _store(self, items):
+        with self._lock:
+            for key, value in items.items():
+                if key in self._entries:
+                    self.size -= len(self._entries.pop(key))
+                # A value larger than the whole budget would evict everything else
+                if len(value) > self.max_bytes:
+                    continue
+                self._entries[key] = value
+                self.size += len(value)
+            while self.size > self.max_bytes:
+                _, value = self._entries.popitem(last=False)
+                self.size -= len(value)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / requests if requests else None,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "maxBytes": self.max_bytes,
+        }
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
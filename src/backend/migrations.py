@@ -0,0 +1,90 @@
+import logging
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Numbered SQL files, applied in order and recorded in schema_migrations
+MIGRATIONS_PATH = os.getenv("MIGRATIONS_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources", "migrations"
+)
+CREATE_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)\s*\(([^)]*)\)",
+    re.IGNORECASE,
+)
+
+
+def _index_columns(connection, table):
+    """Returns {(column, ...): index name} of all indexes on `table`."""
+    return {
+        tuple(
+            row[2]
+            for row in connection.execute(f"PRAGMA index_info('{index[1]}')").fetchall()
+        ): index[1]
+        for index in connection.execute(f"PRAGMA index_list('{table}')").fetchall()
+    }
+
+
+def _statements(script):
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        if line.lstrip().startswith("--"):
+            continue
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+
+
+def _apply(connection, statement):
+    match = CREATE_INDEX.match(statement)
+    if match:
+        name, table, columns = match.groups()
+        columns = tuple(column.strip() for column in columns.split(","))
+        existing = _index_columns(connection, table).get(columns)
+        if existing and existing != name:
+            # Databases built from modules.dbml may have the same index under a generated name
+            logging.info(f"Skipping index {name}, {existing} already covers {columns}")
+            return
+    connection.execute(statement)
+
+
+def apply_migrations(db_path=None, directory=MIGRATIONS_PATH):
+    """Applies all migrations in `directory` that the database has not seen yet."""
+    connection = sqlite3.connect(db_path or os.getenv("DB_PATH"), isolation_level=None)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(name TEXT PRIMARY KEY, applied_at TEXT NOT NULL)"
+    )
+    applied = {
+        row[0] for row in connection.execute("SELECT name FROM schema_migrations")
+    }
+    newly_applied = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".sql") or name in applied:
+            continue
+        with open(os.path.join(directory, name)) as file:
+            script = file.read()
+        connection.execute("BEGIN")
+        try:
+            for statement in _statements(script):
+                _apply(connection, statement)
+            connection.execute(
+                "INSERT INTO schema_migrations (name, applied_at) VALUES (?, ?)",
+                (name, datetime.now(timezone.utc).isoformat()),
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        logging.info(f"Applied migration {name}")
+        newly_applied.append(name)
+    if newly_applied:
+        # Refresh the planner statistics for the new indexes
+        connection.execute("ANALYZE")
+    connection.close()
+    return newly_applied
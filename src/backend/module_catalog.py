@@ -0,0 +1,492 @@
+import hashlib
+import json
+import logging
+
+import numpy as np
+from sqlalchemy.orm import aliased
+
+from backend.db_models import (
+    Session,
+    Module,
+    Organisation,
+    ModuleTopicMapping,
+    Topic,
+    ModulePrerequisiteMapping,
+)
+
+
+def _encode(values):
+    """Integer-codes a sequence of strings. Returns (codes, {value: code}), None is -1."""
+    vocabulary = {}
+    codes = np.fromiter(
+        (
+            -1 if value is None else vocabulary.setdefault(value, len(vocabulary))
+            for value in values
+        ),
+        dtype=np.int32,
+        count=len(values),
+    )
+    return codes, vocabulary
+
+
+def _codes_of(vocabulary, values):
+    return np.asarray(
+        [vocabulary[value] for value in values if value in vocabulary], dtype=np.int32
+    )
+
+
+def _numeric(values):
+    # NULL becomes NaN, which fails every comparison like NULL does in SQL
+    return np.asarray(
+        [np.nan if value is None else value for value in values], dtype=np.float64
+    )
+
+
+class TopicBitmaps:
+    """
+    Inverted index from topic_id to the modules mapped to it, one packed bitset over the
+    catalog positions per topic. Topic filters become OR / AND-NOT over bitsets and the
+    number of matching topics a popcount per module.
+    """
+
+    def __init__(self, topic_ids, module_positions, n_modules):
+        self.n_modules = n_modules
+        self.topic_ids = np.unique(topic_ids)
+        self.bitmaps = np.zeros(
+            (len(self.topic_ids), (n_modules + 7) // 8), dtype=np.uint8
+        )
+        # Same bit order as np.packbits: position 0 is the highest bit of byte 0
+        np.bitwise_or.at(
+            self.bitmaps,
+            (np.searchsorted(self.topic_ids, topic_ids), module_positions >> 3),
+            (0x80 >> (module_positions & 7)).astype(np.uint8),
+        )
+
+    def _rows(self, topic_ids):
+        topic_ids = np.asarray(topic_ids, dtype=np.int64)
+        rows = np.searchsorted(self.topic_ids, topic_ids)
+        found = rows < len(self.topic_ids)
+        found[found] = self.topic_ids[rows[found]] == topic_ids[found]
+        return rows[found]
+
+    def union(self, topic_ids):
+        """Packed bitset of the modules mapped to any of `topic_ids`."""
+        return np.bitwise_or.reduce(
+            self.bitmaps[self._rows(topic_ids)], axis=0, initial=np.uint8(0)
+        )
+
+    def count(self, topic_ids):
+        """Number of `topic_ids` mapped to each module."""
+        bits = np.unpackbits(
+            self.bitmaps[self._rows(topic_ids)], axis=1, count=self.n_modules
+        )
+        return bits.sum(axis=0, dtype=np.int64)
+
+    def unpack(self, bitmap):
+        return np.unpackbits(bitmap, count=self.n_modules).astype(bool)
+
+
+class ModuleCatalog:
+    """
+    Every module that `apply_filters` can return, loaded once into NumPy columns.
+    Language, level, school and department are integer-coded, topics and prerequisite
+    mappings are stored as one flat array per relation with per-module offsets, and topics
+    additionally as bitmaps over the modules. Filters run as vectorized boolean masks
+    instead of a multi-join query per request.
+    """
+
+    def __init__(self, modules, topic_mappings, prerequisite_mappings):
+        # Like the SQL query, only modules with at least one topic are part of the catalog
+        mapped_module_ids = {module_id for module_id, _, _ in topic_mappings}
+        modules = sorted(
+            (module for module in modules if module[0] in mapped_module_ids),
+            key=lambda module: module[0],
+        )
+        (
+            module_ids,
+            self.module_id_uni,
+            self.title,
+            self.description,
+            self.prereq,
+            digital_score,
+            ects,
+            self.lang,
+            self.level,
+            self.org_id,
+            self.chair,
+            self.department,
+            self.school,
+            school_id,
+            department_id,
+        ) = (
+            (list(column) for column in zip(*modules)) if modules else [[]] * 15
+        )
+        self.module_ids = np.asarray(module_ids, dtype=np.int64)
+        self.digital_score = _numeric(digital_score)
+        self.ects = _numeric(ects)
+        self.lang_codes, self.lang_vocabulary = _encode(self.lang)
+        self.level_codes, self.level_vocabulary = _encode(self.level)
+        self.school_id_codes, self.school_id_vocabulary = _encode(school_id)
+        self.department_id_codes, self.department_id_vocabulary = _encode(department_id)
+
+        # Topic mappings of module i: topic_ids[topic_offsets[i] : topic_offsets[i + 1]]
+        positions = {
+            module_id: position for position, module_id in enumerate(module_ids)
+        }
+        topic_mappings = sorted(
+            mapping for mapping in topic_mappings if mapping[0] in positions
+        )
+        self.topic_owner = np.asarray(
+            [positions[module_id] for module_id, _, _ in topic_mappings], dtype=np.int64
+        )
+        self.topic_ids = np.asarray(
+            [topic_id for _, topic_id, _ in topic_mappings], dtype=np.int64
+        )
+        self.topic_offsets = np.searchsorted(
+            self.topic_owner, np.arange(len(module_ids) + 1)
+        )
+        self.topic_bitmaps = TopicBitmaps(
+            self.topic_ids, self.topic_owner, len(module_ids)
+        )
+        self.topic_names = {topic_id: name for _, topic_id, name in topic_mappings}
+        self.topic_ids_by_name = {}
+        for topic_id, name in self.topic_names.items():
+            self.topic_ids_by_name.setdefault(name, []).append(topic_id)
+
+        # Prerequisite mappings, in the same layout and keyed by module_id_uni
+        positions_uni = {
+            module_id_uni: position
+            for position, module_id_uni in enumerate(self.module_id_uni)
+        }
+        prerequisite_mappings = sorted(
+            (positions_uni[module_id_uni], mapping_id, prereq_module_id_uni)
+            for mapping_id, module_id_uni, prereq_module_id_uni in prerequisite_mappings
+            if module_id_uni is not None and module_id_uni in positions_uni
+        )
+        self.prereq_owner = np.asarray(
+            [position for position, _, _ in prerequisite_mappings], dtype=np.int64
+        )
+        self.prereq_module_ids = [
+            prereq_module_id_uni for _, _, prereq_module_id_uni in prerequisite_mappings
+        ]
+        self.prereq_module_codes, self.prereq_module_vocabulary = _encode(
+            self.prereq_module_ids
+        )
+        self.prereq_offsets = np.searchsorted(
+            self.prereq_owner, np.arange(len(module_ids) + 1)
+        )
+        self._positions_uni = None
+
+        # Changes with everything that decides which modules match and in which order, so
+        # cached filter results of another catalog are never served
+        checksum = hashlib.sha256()
+        for array in (
+            self.module_ids,
+            self.digital_score,
+            self.ects,
+            self.topic_ids,
+            self.topic_offsets,
+            self.prereq_offsets,
+        ):
+            checksum.update(array.tobytes())
+        checksum.update(
+            json.dumps(
+                [
+                    self.module_id_uni,
+                    self.lang,
+                    self.level,
+                    school_id,
+                    department_id,
+                    self.topic_names,
+                    self.prereq_module_ids,
+                ],
+                sort_keys=True,
+            ).encode()
+        )
+        self.checksum = checksum.hexdigest()[:16]
+
+    @classmethod
+    def load(cls):
+        with Session() as session:
+            department = aliased(Organisation)
+            school = aliased(Organisation)
+            modules = (
+                session.query(
+                    Module.module_id,
+                    Module.module_id_uni,
+                    Module.name,
+                    Module.description,
+                    Module.prereq,
+                    Module.digital_score,
+                    Module.ects,
+                    Module.lang,
+                    Module.level,
+                    Module.org_id,
+                    Organisation.name,
+                    department.name,
+                    school.name,
+                    Organisation.school_id,
+                    department.org_id,
+                )
+                .outerjoin(Organisation, Module.org_id == Organisation.org_id)
+                .outerjoin(department, Organisation.dep_id == department.org_id)
+                .outerjoin(school, Organisation.school_id == school.org_id)
+                .all()
+            )
+            topic_mappings = (
+                session.query(
+                    ModuleTopicMapping.module_id,
+                    ModuleTopicMapping.topic_id,
+                    Topic.topic,
+                )
+                .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
+                .all()
+            )
+            prerequisite_mappings = session.query(
+                ModulePrerequisiteMapping.module_prerequisite_mapping_id,
+                ModulePrerequisiteMapping.module_id_uni,
+                ModulePrerequisiteMapping.prereq_module_id_uni,
+            ).all()
+        catalog = cls(modules, topic_mappings, prerequisite_mappings)
+        logging.info(f"Loaded {len(catalog)} modules into the module catalog")
+        return catalog
+
+    def __len__(self):
+        return len(self.module_ids)
+
+    def positions_of(self, module_ids):
+        """Catalog positions of `module_ids`, ids that are not in the catalog are dropped."""
+        module_ids = np.asarray(module_ids, dtype=np.int64)
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(
+            np.searchsorted(self.module_ids, module_ids), len(self) - 1
+        )
+        return positions[self.module_ids[positions] == module_ids]
+
+    def position_of_uni(self, module_id_uni):
+        """Catalog position of the module with `module_id_uni`, or None."""
+        if self._positions_uni is None:
+            self._positions_uni = {
+                module_id_uni: position
+                for position, module_id_uni in enumerate(self.module_id_uni)
+            }
+        return self._positions_uni.get(module_id_uni)
+
+    def _topic_ids_named(self, names):
+        return np.asarray(
+            [
+                topic_id
+                for name in set(names)
+                for topic_id in self.topic_ids_by_name.get(name, ())
+            ],
+            dtype=np.int64,
+        )
+
+    def _count_prerequisites(self, prereq_module_ids):
+        """Number of distinct `prereq_module_ids` among the prerequisites of each module."""
+        matching = np.isin(
+            self.prereq_module_codes,
+            _codes_of(self.prereq_module_vocabulary, prereq_module_ids),
+        )
+        # A prerequisite can be mapped several times (from several extracted identifiers)
+        pairs = np.unique(
+            np.stack((self.prereq_owner[matching], self.prereq_module_codes[matching])),
+            axis=1,
+        )
+        return np.bincount(pairs[0], minlength=len(self))
+
+    def conditions(
+        self,
+        languages=None,
+        study_levels=None,
+        ects_min=None,
+        ects_max=None,
+        digital_score_min=None,
+        digital_score_max=None,
+        school_ids=None,
+        department_ids=None,
+        topics_of_interest=(),
+        excluded_topics=(),
+    ):
+        """
+        Returns a boolean mask over the catalog per active filter, keyed by the filter
+        ("languages", "study_levels", "ects", "digital_score", "school_ids",
+        "department_ids" or "topics"). Arguments are already mapped to stored values,
+        e.g. study_levels is the tuple of levels a study level accepts.
+        """
+        conditions = {}
+        if languages:
+            conditions["languages"] = np.isin(
+                self.lang_codes, _codes_of(self.lang_vocabulary, languages)
+            )
+        if study_levels:
+            conditions["study_levels"] = np.isin(
+                self.level_codes, _codes_of(self.level_vocabulary, study_levels)
+            )
+        for name, column, minimum, maximum in (
+            ("ects", self.ects, ects_min, ects_max),
+            ("digital_score", self.digital_score, digital_score_min, digital_score_max),
+        ):
+            if minimum is not None and maximum is not None:
+                conditions[name] = (column >= minimum) & (column <= maximum)
+            elif minimum is not None:
+                conditions[name] = column >= minimum
+            elif maximum is not None:
+                conditions[name] = column <= maximum
+        if school_ids:
+            conditions["school_ids"] = np.isin(
+                self.school_id_codes,
+                _codes_of(self.school_id_vocabulary, school_ids),
+            )
+        if department_ids:
+            conditions["department_ids"] = np.isin(
+                self.department_id_codes,
+                _codes_of(self.department_id_vocabulary, department_ids),
+            )
+        if topics_of_interest or excluded_topics:
+            if topics_of_interest:
+                topics_filter = self.topic_bitmaps.union(
+                    self._topic_ids_named(topics_of_interest)
+                )
+            else:
+                topics_filter = np.full(
+                    self.topic_bitmaps.bitmaps.shape[1], 0xFF, dtype=np.uint8
+                )
+            if excluded_topics:
+                topics_filter &= ~self.topic_bitmaps.union(
+                    self._topic_ids_named(excluded_topics)
+                )
+            conditions["topics"] = self.topic_bitmaps.unpack(topics_filter)
+        return conditions
+
+    def _select(self, conditions, matching_prerequisites):
+        if not conditions:
+            return np.ones(len(self), dtype=bool)
+        mask = np.logical_and.reduce(list(conditions.values()))
+        # Modules building on previous modules are kept regardless of the filters
+        mask |= matching_prerequisites > 0
+        return mask
+
+    def filter(self, previous_modules=(), topics_of_interest=(), **filters):
+        """
+        Returns the catalog positions of all matching modules in the order of `apply_filters`:
+        most matching topics of interest first, then most previous modules among the
+        prerequisites, then by module_id. Takes the arguments of `conditions`.
+        """
+        matching_prerequisites = self._count_prerequisites(previous_modules or ())
+        mask = self._select(
+            self.conditions(topics_of_interest=topics_of_interest, **filters),
+            matching_prerequisites,
+        )
+
+        topic_score = self.topic_bitmaps.count(
+            self._topic_ids_named(topics_of_interest or ())
+        )
+
+        positions = np.flatnonzero(mask)
+        order = np.lexsort(
+            (
+                self.module_ids[positions],
+                -matching_prerequisites[positions],
+                -topic_score[positions],
+            )
+        )
+        return positions[order]
+
+    def facet_counts(self, options, previous_modules=(), **filters):
+        """
+        Counts the matching modules per option of every facet. Each facet is counted under
+        all filters except its own, so the counts are what selecting the option would
+        return. `options` maps the coded facets ("languages", "study_levels",
+        "school_ids", "department_ids") to {option: stored values}, "ects" and
+        "digital_score" are counted per distinct value. Takes the filters of `conditions`.
+        """
+        conditions = self.conditions(**filters)
+        matching_prerequisites = self._count_prerequisites(previous_modules or ())
+        coded = {
+            "languages": (self.lang_codes, self.lang_vocabulary),
+            "study_levels": (self.level_codes, self.level_vocabulary),
+            "school_ids": (self.school_id_codes, self.school_id_vocabulary),
+            "department_ids": (self.department_id_codes, self.department_id_vocabulary),
+        }
+        numeric = {"ects": self.ects, "digital_score": self.digital_score}
+
+        # Selecting an option always adds a filter, so the modules building on previous
+        # modules are part of every count
+        kept = matching_prerequisites > 0
+        n_kept = int(kept.sum())
+        counts = {}
+        for facet in (*coded, *numeric):
+            others = [m for name, m in conditions.items() if name != facet]
+            mask = np.logical_and.reduce([*others, ~kept])
+            if facet in coded:
+                codes, vocabulary = coded[facet]
+                codes = codes[mask]
+                histogram = np.bincount(codes[codes >= 0], minlength=len(vocabulary))
+                counts[facet] = {
+                    option: int(histogram[_codes_of(vocabulary, values)].sum()) + n_kept
+                    for option, values in options.get(facet, {}).items()
+                }
+            else:
+                column = numeric[facet]
+                values, value_counts = np.unique(
+                    column[mask & ~np.isnan(column)], return_counts=True
+                )
+                matching = dict(zip(values, value_counts))
+                counts[facet] = {
+                    _scalar(value): int(matching.get(value, 0)) + n_kept
+                    for value in np.unique(column[(mask | kept) & ~np.isnan(column)])
+                }
+        return counts
+
+    def records(self, positions, fields):
+        """Builds the `apply_filters` result dicts of the modules at `positions`."""
+        getters = [(field, self._getters[field]) for field in fields]
+        return [
+            {field: get(position) for field, get in getters}
+            for position in np.asarray(positions).tolist()
+        ]
+
+    @property
+    def _getters(self):
+        return {
+            "id": self.module_id_uni.__getitem__,
+            "title": self.title.__getitem__,
+            "description": self.description.__getitem__,
+            "prereq": self.prereq.__getitem__,
+            "digitalScore": lambda position: _scalar(self.digital_score[position]),
+            "ects": lambda position: _scalar(self.ects[position]),
+            "language": self.lang.__getitem__,
+            "studyLevel": self.level.__getitem__,
+            "OrgId": self.org_id.__getitem__,
+            "chair": self.chair.__getitem__,
+            "department": self.department.__getitem__,
+            "school": self.school.__getitem__,
+            "topics": self._topics,
+            "prereqModules": self._prereq_modules,
+        }
+
+    def _topics(self, position):
+        topic_ids = self.topic_ids[
+            self.topic_offsets[position] : self.topic_offsets[position + 1]
+        ]
+        return list(
+            dict.fromkeys(self.topic_names[topic_id] for topic_id in topic_ids.tolist())
+        )
+
+    def _prereq_modules(self, position):
+        prereq_modules = self.prereq_module_ids[
+            self.prereq_offsets[position] : self.prereq_offsets[position + 1]
+        ]
+        return sorted(
+            {
+                prereq_module_id
+                for prereq_module_id in prereq_modules
+                if prereq_module_id is not None
+            }
+        )
+
+
+def _scalar(value):
+    return None if np.isnan(value) else int(value)
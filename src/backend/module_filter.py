@@ -1,6 +1,12 @@
+import hashlib
 import itertools
+import json
+import os
 from functools import lru_cache
-from sqlalchemy import func, distinct, or_, case, select
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import func, distinct, or_, select
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql import and_
 
@@ -18,8 +24,59 @@ from backend.db_models import (
     ModuleTopicMapping,
     Topic,
     ModulePrerequisiteMapping,
+    ModuleServing,
 )
+from backend.memory_cache import MemoryCache
+from backend.module_catalog import ModuleCatalog
+from backend.module_serving import module_serving_available
+from backend.sqlite_cache import SqliteCache
+
+load_dotenv()
 
+# "catalog" filters the in-memory module catalog, which every process loads anyway to
+# build the listed modules and the facets. "sql" runs every filter combination as a query
+# and only saves the topic bitmaps of the catalog.
+MODULE_FILTER_ENGINE = os.getenv("MODULE_FILTER_ENGINE", "catalog")
+# Filter results are cached as ordered module ids, at most this many bytes per process
+FILTER_CACHE_MAX_BYTES = int(os.getenv("FILTER_CACHE_MAX_BYTES", 32 * 2**20))
+# Optional SQLite file all worker processes share their cached filter results through
+FILTER_CACHE_PATH = os.getenv("FILTER_CACHE_PATH")
+FILTER_CACHE_SHARED_MAX_BYTES = int(
+    os.getenv("FILTER_CACHE_SHARED_MAX_BYTES", 256 * 2**20)
+)
+
+# Keys of the module dicts returned by apply_filters, in response order
+MODULE_FIELDS = (
+    "id",
+    "title",
+    "description",
+    "prereq",
+    "digitalScore",
+    "ects",
+    "language",
+    "studyLevel",
+    "OrgId",
+    "chair",
+    "department",
+    "school",
+    "topics",
+    "prereqModules",
+)
+# Named projections for the listing endpoints, e.g. title lists only need a summary
+MODULE_PROJECTIONS = {
+    "summary": (
+        "id",
+        "title",
+        "digitalScore",
+        "ects",
+        "language",
+        "studyLevel",
+        "chair",
+        "department",
+        "school",
+    ),
+    "full": MODULE_FIELDS,
+}
 
 language_mapper = {
     "English": ("English", "German/English", "Unknown"),
@@ -76,29 +133,86 @@ department_mapper = {
 }
 
 
-@lru_cache
+def resolve_fields(fields=(), projection=None):
+    """
+    Returns the module fields to select for a `projection` and/or a list of `fields`, in
+    MODULE_FIELDS order. Without either all fields are returned, "id" is always included.
+    """
+    if projection and projection not in MODULE_PROJECTIONS:
+        raise ValueError(
+            f"Unknown projection {projection!r}, expected one of {list(MODULE_PROJECTIONS)}"
+        )
+    unknown = [field for field in fields if field not in MODULE_FIELDS]
+    if unknown:
+        raise ValueError(
+            f"Unknown fields {unknown}, expected any of {list(MODULE_FIELDS)}"
+        )
+    requested = set(fields) | {"id"}
+    if projection:
+        requested |= set(MODULE_PROJECTIONS[projection])
+    elif not fields:
+        requested = set(MODULE_FIELDS)
+    return tuple(field for field in MODULE_FIELDS if field in requested)
+
+
+@lru_cache(maxsize=None)
+def module_catalog():
+    return ModuleCatalog.load()
+
+
+@lru_cache(maxsize=None)
+def filter_cache():
+    shared = None
+    if FILTER_CACHE_PATH:
+        shared = SqliteCache(
+            FILTER_CACHE_PATH, "filter_results", max_bytes=FILTER_CACHE_SHARED_MAX_BYTES
+        )
+    return MemoryCache(FILTER_CACHE_MAX_BYTES, shared=shared)
+
+
 def modules_by_id(module_ids):
+    """
+    The id and title of the modules with the given module_id_uni, in module_id order. They
+    are read from the module catalog, only modules without topics need a query.
+    """
     if not module_ids:
         return []
     logging.info(f"{module_ids=}")
-    session = Session()
-    modules = (
-        session.query(Module.module_id_uni, Module.name)
-        .filter(Module.module_id_uni.in_(module_ids))
-        .all()
-    )
-    modules_dict = [
+    catalog = module_catalog()
+    positions = {
+        module_id_uni: catalog.position_of_uni(module_id_uni)
+        for module_id_uni in module_ids
+    }
+    modules = [
+        (
+            int(catalog.module_ids[position]),
+            catalog.module_id_uni[position],
+            catalog.title[position],
+        )
+        for position in positions.values()
+        if position is not None
+    ]
+    missing = [
+        module_id_uni
+        for module_id_uni, position in positions.items()
+        if position is None
+    ]
+    if missing:
+        with Session() as session:
+            modules += (
+                session.query(Module.module_id, Module.module_id_uni, Module.name)
+                .filter(Module.module_id_uni.in_(missing))
+                .all()
+            )
+    return [
         {
-            "id": r[0],
-            "title": r[1],
+            "id": module_id_uni,
+            "title": title,
         }
-        for r in modules
+        for _, module_id_uni, title in sorted(modules, key=lambda module: module[0])
     ]
-    session.close()
-    return modules_dict
 
 
-@lru_cache
 def apply_filters(
     schools,
     study_level,
@@ -111,39 +225,202 @@ def apply_filters(
     previous_modules,
     topics_of_interest,
     excluded_topics,
+    fields=MODULE_FIELDS,
+):
+    """
+    Returns the matching modules as dicts with the keys `fields`, best matches first. The
+    dicts are built from the module catalog on every call, callers may modify them.
+    """
+    module_ids = cached_module_ids(
+        schools,
+        study_level,
+        ects_min,
+        ects_max,
+        digital_score_min,
+        digital_score_max,
+        module_languages,
+        departments,
+        previous_modules,
+        topics_of_interest,
+        excluded_topics,
+    )
+    catalog = module_catalog()
+    return catalog.records(catalog.positions_of(module_ids), fields)
+
+
+def apply_filters_page(
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+    page=1,
+    size=5,
+    fields=MODULE_FIELDS,
 ):
-    session = Session()
+    """
+    Like `apply_filters`, but only builds the modules of one page. Returns the modules of
+    the page and the total number of matching modules.
+    """
+    module_ids = cached_module_ids(
+        schools,
+        study_level,
+        ects_min,
+        ects_max,
+        digital_score_min,
+        digital_score_max,
+        module_languages,
+        departments,
+        previous_modules,
+        topics_of_interest,
+        excluded_topics,
+    )
+    # The ids come from the database, which an ETL run may have changed since the catalog
+    # was loaded, so the page and the total only count modules the catalog can build
+    catalog = module_catalog()
+    positions = catalog.positions_of(module_ids)
+    offset = max(page - 1, 0) * size
+    return (
+        catalog.records(positions[offset : offset + size], fields),
+        len(positions),
+    )
+
+
+def cached_module_ids(*filters):
+    """
+    The ordered module_ids matching the filters of `apply_filters`, as a read-only array.
+    Looked up in the filter cache first, the key ignores the order of list filters.
+    """
+    catalog = module_catalog()
+    key = f"{catalog.checksum}:{hashlib.sha256(filters_json(filters).encode()).hexdigest()}"
+    cache = filter_cache()
+    value = cache.get(key)
+    if value is None:
+        value = filtered_module_ids(*filters).astype("<i8").tobytes()
+        cache.set(key, value)
+    # Arrays over bytes are read-only, so cache hits cannot be modified by callers
+    return np.frombuffer(value, dtype="<i8")
+
+
+def filters_json(filters):
+    """The filters of `apply_filters` as JSON, list filters sorted and without duplicates."""
+    return json.dumps(
+        [
+            sorted(set(value)) if isinstance(value, (tuple, list)) else value
+            for value in filters
+        ]
+    )
+
+
+def filtered_module_ids(*filters):
+    """Runs the filters of `apply_filters` with the configured engine, see cached_module_ids."""
+    if MODULE_FILTER_ENGINE == "catalog":
+        catalog, positions = filter_catalog(*filters)
+        return catalog.module_ids[positions]
+    table = ModuleServing if module_serving_available() else Module
+    with Session() as session:
+        query = modules_query(session, *filters, ("id",)).with_entities(table.module_id)
+        return np.asarray([row[0] for row in query], dtype=np.int64)
+
+
+def modules_query(session, *filters):
+    """
+    The ordered module query of `apply_filters`, read from the pre-joined module_serving
+    table once the ETL has built it and from the normalized tables otherwise.
+    """
+    if module_serving_available():
+        return serving_modules_query(session, *filters)
+    return filtered_modules_query(session, *filters)
+
+
+def filtered_modules_query(
+    session,
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+    fields=MODULE_FIELDS,
+):
+    """
+    Builds the ordered query behind `apply_filters`, one row per module with a column for
+    each of `fields`.
+    """
     department = aliased(Organisation)
     school = aliased(Organisation)
 
-    # Base query with added custom ordering fields
-    query = (
-        session.query(
-            Module.module_id_uni,
-            Module.name,
-            Module.description,
-            Module.prereq,
-            Module.digital_score,
-            Module.ects,
-            Module.lang,
-            Module.level,
-            Module.org_id,
-            Organisation.name.label("organisation"),
-            department.name.label("department"),
-            school.name.label("school"),
-            func.group_concat(distinct(Topic.topic)).label("topics"),
-            func.group_concat(
-                distinct(ModulePrerequisiteMapping.prereq_module_id_uni)
-            ).label("prereqModules"),
+    # Topics and prerequisites are looked up per candidate module through the module
+    # indexes of the mapping tables, so the work grows with the result and not with the
+    # mapping tables, and every module stays a single row
+    def topic_mappings(topics):
+        return select(ModuleTopicMapping.topic_id).where(
+            ModuleTopicMapping.module_id == Module.module_id,
+            ModuleTopicMapping.topic_id.in_(
+                select(Topic.topic_id).where(Topic.topic.in_(topics))
+            ),
         )
+
+    def previous_module_mappings():
+        return select(ModulePrerequisiteMapping.module_prerequisite_mapping_id).where(
+            ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni,
+            ModulePrerequisiteMapping.prereq_module_id_uni.in_(previous_modules),
+        )
+
+    topic_names = (
+        select(func.group_concat(distinct(Topic.topic)))
+        .select_from(ModuleTopicMapping)
+        .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
+        .where(ModuleTopicMapping.module_id == Module.module_id)
+        .scalar_subquery()
+    )
+    prerequisite_modules = (
+        select(
+            func.group_concat(distinct(ModulePrerequisiteMapping.prereq_module_id_uni))
+        )
+        .where(ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni)
+        .scalar_subquery()
+    )
+
+    columns = {
+        "id": Module.module_id_uni,
+        "title": Module.name,
+        "description": Module.description,
+        "prereq": Module.prereq,
+        "digitalScore": Module.digital_score,
+        "ects": Module.ects,
+        "language": Module.lang,
+        "studyLevel": Module.level,
+        "OrgId": Module.org_id,
+        "chair": Organisation.name.label("organisation"),
+        "department": department.name.label("department"),
+        "school": school.name.label("school"),
+        "topics": topic_names.label("topics"),
+        "prereqModules": prerequisite_modules.label("prereqModules"),
+    }
+
+    # Base query, modules without topics are not listed
+    query = (
+        session.query(*[columns[field] for field in fields])
+        .select_from(Module)
         .outerjoin(Organisation, Module.org_id == Organisation.org_id)
         .outerjoin(department, Organisation.dep_id == department.org_id)
         .outerjoin(school, Organisation.school_id == school.org_id)
-        .join(ModuleTopicMapping, Module.module_id == ModuleTopicMapping.module_id)
-        .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
-        .outerjoin(
-            ModulePrerequisiteMapping,
-            ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni,
+        .filter(
+            select(ModuleTopicMapping.topic_id)
+            .where(ModuleTopicMapping.module_id == Module.module_id)
+            .exists()
         )
     )
 
@@ -184,85 +461,297 @@ def apply_filters(
         filters_and.append(department.org_id.in_(department_ids))
 
     if previous_modules:
-        previous_module_exists = (
-            session.query(ModulePrerequisiteMapping)
-            .filter(
-                and_(
-                    ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni,
-                    ModulePrerequisiteMapping.prereq_module_id_uni.in_(
-                        previous_modules
-                    ),
-                )
-            )
-            .correlate(Module)
-            .exists()
-        )
-        filters_or.append(previous_module_exists)
+        filters_or.append(previous_module_mappings().exists())
+
     if topics_of_interest:
-        filters_and.append(
-            session.query(Topic.topic_id)
-            .filter(
-                and_(
-                    Module.module_id == ModuleTopicMapping.module_id,
-                    ModuleTopicMapping.topic_id == Topic.topic_id,
-                    Topic.topic.in_(topics_of_interest),
-                )
-            )
-            .correlate(Module)
-            .exists()
-        )
+        filters_and.append(topic_mappings(topics_of_interest).exists())
 
     if excluded_topics:
         logging.info(f"{excluded_topics}")
-        excluded_modules_subquery = (
-            session.query(Module.module_id)
-            .join(ModuleTopicMapping, Module.module_id == ModuleTopicMapping.module_id)
-            .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
-            .filter(Topic.topic.in_(excluded_topics))
-            .subquery()
+        filters_and.append(~topic_mappings(excluded_topics).exists())
+
+    # Apply filters only if they exist
+    if filters_and:
+        query = query.filter(or_(and_(*filters_and), *filters_or))
+
+    # Order by the number of matching topics of interest, then by the number of previous
+    # modules among the prerequisites
+    ordering = []
+    if topics_of_interest:
+        # Modules with more matching topics of interest first
+        matching_topics = (
+            topic_mappings(topics_of_interest)
+            .with_only_columns(func.count())
+            .scalar_subquery()
+        )
+        ordering.append(matching_topics.desc())
+    if previous_modules:
+        # Distinct previous modules among the prerequisites, one prerequisite can be
+        # mapped from several extracted identifiers
+        matching_prerequisites = (
+            previous_module_mappings()
+            .with_only_columns(
+                func.count(distinct(ModulePrerequisiteMapping.prereq_module_id_uni))
+            )
+            .scalar_subquery()
         )
+        ordering.append(matching_prerequisites.desc())
+    # Stable order, so pages do not overlap
+    return query.order_by(*ordering, Module.module_id)
+
 
-        # Now we use select to explicitly refer to the module_id in the subquery
-        filters_and.append(
-            ~Module.module_id.in_(select(excluded_modules_subquery.c.module_id))
+def serving_modules_query(
+    session,
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+    fields=MODULE_FIELDS,
+):
+    """
+    Same rows and order as `filtered_modules_query`, but from module_serving: no joins or
+    aggregation at request time, only correlated lookups for topic and prerequisite filters.
+    """
+    columns = {
+        "id": ModuleServing.module_id_uni,
+        "title": ModuleServing.name,
+        "description": ModuleServing.description,
+        "prereq": ModuleServing.prereq,
+        "digitalScore": ModuleServing.digital_score,
+        "ects": ModuleServing.ects,
+        "language": ModuleServing.lang,
+        "studyLevel": ModuleServing.level,
+        "OrgId": ModuleServing.org_id,
+        "chair": ModuleServing.chair,
+        "department": ModuleServing.department,
+        "school": ModuleServing.school,
+        "topics": ModuleServing.topics,
+        "prereqModules": ModuleServing.prereq_modules,
+    }
+    query = session.query(*[columns[field] for field in fields])
+
+    def topic_mappings(topics):
+        return select(ModuleTopicMapping.topic_id).where(
+            ModuleTopicMapping.module_id == ModuleServing.module_id,
+            ModuleTopicMapping.topic_id.in_(
+                select(Topic.topic_id).where(Topic.topic.in_(topics))
+            ),
         )
 
-    # Apply filters only if they exist
+    def previous_module_mappings():
+        return select(ModulePrerequisiteMapping.module_prerequisite_mapping_id).where(
+            ModulePrerequisiteMapping.module_id_uni == ModuleServing.module_id_uni,
+            ModulePrerequisiteMapping.prereq_module_id_uni.in_(previous_modules),
+        )
+
+    filters_and = []
+    filters_or = []
+
+    if module_languages:
+        languages_mapped = set(
+            itertools.chain.from_iterable(
+                [language_mapper[lang] for lang in module_languages]
+            )
+        )
+        filters_and.append(ModuleServing.lang.in_(languages_mapped))
+
+    if study_level:
+        filters_and.append(ModuleServing.level.in_(study_level_mapper[study_level]))
+
+    if ects_min is not None:
+        filters_and.append(ModuleServing.ects >= ects_min)
+
+    if ects_max is not None:
+        filters_and.append(ModuleServing.ects <= ects_max)
+
+    if digital_score_min is not None:
+        filters_and.append(ModuleServing.digital_score >= digital_score_min)
+
+    if digital_score_max is not None:
+        filters_and.append(ModuleServing.digital_score <= digital_score_max)
+
+    if schools:
+        school_ids = [school_mapper[school] for school in schools]
+        filters_and.append(ModuleServing.school_id.in_(school_ids))
+
+    if departments:
+        department_ids = [department_mapper[department] for department in departments]
+        filters_and.append(ModuleServing.department_id.in_(department_ids))
+
+    if previous_modules:
+        filters_or.append(previous_module_mappings().exists())
+
+    if topics_of_interest:
+        filters_and.append(topic_mappings(topics_of_interest).exists())
+
+    if excluded_topics:
+        filters_and.append(~topic_mappings(excluded_topics).exists())
+
     if filters_and:
         query = query.filter(or_(and_(*filters_and), *filters_or))
 
-    # Order by the number of matching topics of interest and whether it has previous modules as prerequisites
-    query = query.order_by(
-        func.sum(
-            case((Topic.topic.in_(topics_of_interest), 1), else_=0)
-        ).desc(),  # Modules with more matching topics of interest first
-        func.sum(
-            ModulePrerequisiteMapping.prereq_module_id_uni.in_(previous_modules)
-        ).desc(),  # Modules with previous modules as prerequisites on top
+    # Same order as filtered_modules_query
+    ordering = []
+    if topics_of_interest:
+        matching_topics = (
+            topic_mappings(topics_of_interest)
+            .with_only_columns(func.count())
+            .scalar_subquery()
+        )
+        ordering.append(matching_topics.desc())
+    if previous_modules:
+        matching_prerequisites = (
+            previous_module_mappings()
+            .with_only_columns(
+                func.count(distinct(ModulePrerequisiteMapping.prereq_module_id_uni))
+            )
+            .scalar_subquery()
+        )
+        ordering.append(matching_prerequisites.desc())
+    return query.order_by(*ordering, ModuleServing.module_id)
+
+
+def module_dict(r, fields=MODULE_FIELDS):
+    module = dict(zip(fields, r))
+    # Aggregated lists come back as comma separated strings
+    for field in ("topics", "prereqModules"):
+        if field in module:
+            module[field] = module[field].split(",") if module[field] else []
+    return module
+
+
+def filter_catalog(
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+):
+    """
+    Runs the filters of `apply_filters` on the in-memory catalog. Returns the catalog and
+    the ordered positions of the matching modules.
+    """
+    catalog = module_catalog()
+    positions = catalog.filter(
+        **catalog_filters(
+            schools,
+            study_level,
+            ects_min,
+            ects_max,
+            digital_score_min,
+            digital_score_max,
+            module_languages,
+            departments,
+            previous_modules,
+            topics_of_interest,
+            excluded_topics,
+        )
     )
-    # Execute the query
-    filtered_modules = query.group_by(
-        Module.module_id, Organisation.name, department.name, school.name
-    ).all()
+    return catalog, positions
 
-    module_dicts = [
-        {
-            "id": r[0],
-            "title": r[1],
-            "description": r[2],
-            "prereq": r[3],
-            "digitalScore": r[4],
-            "ects": r[5],
-            "language": r[6],
-            "studyLevel": r[7],
-            "OrgId": r[8],
-            "chair": r[9],
-            "department": r[10],
-            "school": r[11],
-            "topics": r[12].split(",") if r[12] else [],
-            "prereqModules": r[13].split(",") if r[13] else [],
-        }
-        for r in filtered_modules
-    ]
-    session.close()
-    return module_dicts
+
+def facet_counts(
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+):
+    """
+    Counts per filter option how many modules the filters of `apply_filters` would return
+    with that option selected, i.e. every facet ignores its own filter. Returns
+    {facet: [{"value": option, "count": n}, ...]} for the filter sidebar.
+    """
+    counts = module_catalog().facet_counts(
+        options={
+            "languages": language_mapper,
+            "study_levels": study_level_mapper,
+            "school_ids": {
+                school: (school_id,) for school, school_id in school_mapper.items()
+            },
+            "department_ids": {
+                department: (department_id,)
+                for department, department_id in department_mapper.items()
+            },
+        },
+        **catalog_filters(
+            schools,
+            study_level,
+            ects_min,
+            ects_max,
+            digital_score_min,
+            digital_score_max,
+            module_languages,
+            departments,
+            previous_modules,
+            topics_of_interest,
+            excluded_topics,
+        ),
+    )
+    return {
+        facet: [
+            {"value": value, "count": count} for value, count in counts[key].items()
+        ]
+        for facet, key in (
+            ("schools", "school_ids"),
+            ("departments", "department_ids"),
+            ("languages", "languages"),
+            ("studyLevels", "study_levels"),
+            ("ects", "ects"),
+            ("digitalScores", "digital_score"),
+        )
+    }
+
+
+def catalog_filters(
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+):
+    """Maps the filters of `apply_filters` to the stored values the catalog filters on."""
+    return dict(
+        languages=set(
+            itertools.chain.from_iterable(
+                [language_mapper[lang] for lang in module_languages or ()]
+            )
+        ),
+        study_levels=study_level_mapper[study_level] if study_level else None,
+        ects_min=ects_min,
+        ects_max=ects_max,
+        digital_score_min=digital_score_min,
+        digital_score_max=digital_score_max,
+        school_ids=[school_mapper[school] for school in schools or ()],
+        department_ids=[
+            department_mapper[department] for department in departments or ()
+        ],
+        previous_modules=previous_modules,
+        topics_of_interest=topics_of_interest,
+        excluded_topics=excluded_topics,
+    )
@@ -1,11 +1,39 @@
 import logging
-from functools import lru_cache, cache
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from openai import OpenAI, RateLimitError
+from openai import RateLimitError
 
-# Initialize the OpenAI client
-client = OpenAI()
+from backend.embeddings import openai_client
+from backend.json_stream import ArrayItemParser
+from backend.module_summaries import module_summaries
+from backend.prompt_budget import allocate_tokens, count_tokens, truncate_tokens
+from backend.response_cache import cached_response, cached_response_stream, response_key
+
+load_dotenv()
+
+RANKING_MODEL = "gpt-4o"
+# Part of the response cache key, bump it whenever the prompt or ModuleRankings changes
+RANKING_PROMPT_VERSION = 2
+# Longer candidate lists are ranked in shards of this size by concurrent LLM calls
+RANKING_SHARD_SIZE = int(os.getenv("RANKING_SHARD_SIZE", 20))
+# Shards of one ranking requested at the same time
+RANKING_SHARD_WORKERS = int(os.getenv("RANKING_SHARD_WORKERS", 4))
+# Ranking calls (streamed or not) in flight per process, over all requests, to stay below
+# rate limits
+RANKING_MAX_CONCURRENT_CALLS = int(os.getenv("RANKING_MAX_CONCURRENT_CALLS", 8))
+# The top k of the merged shard rankings are ranked again in one call, 0 disables it
+RANKING_REFINE_TOP_K = int(os.getenv("RANKING_REFINE_TOP_K", 0))
+
+# Upper bound of the ranking prompt, module texts are cut to fit (see fit_prompt_budget)
+RANKING_MAX_PROMPT_TOKENS = int(os.getenv("RANKING_MAX_PROMPT_TOKENS", 8000))
+# Free-text fields of a module in the ranking prompt, cut to fit the budget
+TEXT_FIELDS = ("summary", "description", "prereq")
+
+_ranking_calls = threading.BoundedSemaphore(RANKING_MAX_CONCURRENT_CALLS)
 
 
 # Model representing a module with an associated reasoning for its ranking
@@ -24,25 +52,197 @@ class ModuleRankings(BaseModel):
     )
 
 
+def ranking_key(student_input, modules):
+    return response_key(
+        "ranking",
+        RANKING_MODEL,
+        RANKING_PROMPT_VERSION,
+        student_input,
+        [dict(module)["id"] for module in modules],
+    )
+
+
+def ranking_messages(student_input, modules):
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful tutor at the help office of TUM university. You will be provided with a list of modules containing fields such as module id, description, language, etc. Some modules come with a summary of their description and prerequisites instead. Also, you will be provided with a message from a student. Please rank the modules according to the student's message. Provide a reason for each module. For the reason please be brief (max 2 sentences). You do not need to repeat the title of the module.",
+        },
+        {"role": "user", "content": f"Student input: {student_input}"},
+    ]
+    modules = fit_prompt_budget(messages, modules)
+    return messages + [{"role": "user", "content": f"Modules:\n{modules}"}]
+
+
+def fit_prompt_budget(messages, modules, max_tokens=RANKING_MAX_PROMPT_TOKENS):
+    """
+    Compacts `modules` (tuples of (field, value) pairs) for the ranking prompt: the
+    description and prerequisites are replaced by the module's summary where one is
+    stored, then the free texts of the longest modules are cut to an even share until the
+    prompt with `messages` fits into `max_tokens`.
+    """
+    modules = [dict(module) for module in modules]
+    summaries = module_summaries(modules)
+    for module in modules:
+        if module["id"] in summaries:
+            module.pop("description", None)
+            module.pop("prereq", None)
+            module["summary"] = summaries[module["id"]]
+
+    fixed_tokens = sum(count_tokens(message["content"]) for message in messages)
+    text_tokens = []
+    for module in modules:
+        fixed_tokens += count_tokens(
+            str(
+                frozenset(
+                    (key, "" if key in TEXT_FIELDS else value)
+                    for key, value in module.items()
+                )
+            )
+        )
+        text_tokens.append(
+            [count_tokens(module.get(field) or "") for field in TEXT_FIELDS]
+        )
+    if fixed_tokens + sum(map(sum, text_tokens)) > max_tokens:
+        cap = allocate_tokens(map(sum, text_tokens), max_tokens - fixed_tokens)
+        logging.info(
+            f"Ranking prompt over budget, cutting module texts to {cap} tokens"
+        )
+        for module, field_tokens in zip(modules, text_tokens):
+            # Within a module the cap is shared the same way, so short prerequisites
+            # stay whole next to a long description
+            field_cap = allocate_tokens(field_tokens, cap)
+            for field in TEXT_FIELDS:
+                if field in module:
+                    module[field] = truncate_tokens(module[field] or "", field_cap)
+    return tuple(frozenset(module.items()) for module in modules)
+
+
 # Function to rank modules based on student input
-@cache
 def rank_modules(student_input, modules: tuple):
+    """
+    Ranks `modules` (tuples of (field, value) pairs) for the student input. Rankings are
+    cached on disk per student input and set of module ids.
+    """
+    ranked_modules = cached_response(
+        ranking_key(student_input, modules),
+        lambda: [
+            ranked_module.model_dump()
+            for ranked_module in request_rankings(student_input, modules)
+        ],
+    )
+    return [RankedModule(**ranked_module) for ranked_module in ranked_modules]
+
+
+def rank_modules_sharded(
+    student_input,
+    modules: tuple,
+    shard_size=RANKING_SHARD_SIZE,
+    max_workers=RANKING_SHARD_WORKERS,
+    refine_top_k=RANKING_REFINE_TOP_K,
+):
+    """
+    Ranks `modules` like `rank_modules`, but splits lists longer than `shard_size` into
+    shards that are ranked concurrently, so the latency stays close to that of one shard.
+    The modules are dealt to the shards in turn, so each shard gets a similar share of the
+    (pre-ranked) best candidates. The shard rankings are merged by relative rank, and with
+    `refine_top_k` the top of the merged ranking is ranked again in one call.
+    """
+    if len(modules) <= shard_size:
+        return rank_modules(student_input, modules)
+
+    shard_count = -(-len(modules) // shard_size)
+    shards = [modules[shard::shard_count] for shard in range(shard_count)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_rankings = list(
+            executor.map(lambda shard: rank_modules(student_input, shard), shards)
+        )
+    ranked_modules = merge_rankings(shards, shard_rankings)
+
+    if refine_top_k > 1:
+        by_id = {dict(module)["id"]: module for module in modules}
+        top = ranked_modules[:refine_top_k]
+        top_modules = tuple(by_id[ranked_module.module_id] for ranked_module in top)
+        refined = merge_rankings(
+            [top_modules], [rank_modules(student_input, top_modules)]
+        )
+        # Modules the refinement left out keep their merged order and reasoning
+        refined_ids = {ranked_module.module_id for ranked_module in refined}
+        ranked_modules = (
+            refined
+            + [module for module in top if module.module_id not in refined_ids]
+            + ranked_modules[refine_top_k:]
+        )
+    return ranked_modules
+
+
+def merge_rankings(shards, shard_rankings):
+    """
+    Merges the rankings of `shards` by relative rank (rank / shard length), ties go to the
+    earlier shard. Ids the LLM made up or repeated are dropped, modules it left out are
+    missing from the result like from a single ranking.
+    """
+    positions = []
+    for shard_index, (shard, ranking) in enumerate(zip(shards, shard_rankings)):
+        unranked = {dict(module)["id"] for module in shard}
+        rank = 0
+        for ranked_module in ranking:
+            if ranked_module.module_id not in unranked:
+                continue
+            unranked.remove(ranked_module.module_id)
+            positions.append((rank / len(shard), shard_index, ranked_module))
+            rank += 1
+    positions.sort(key=lambda position: position[:2])
+    return [ranked_module for _, _, ranked_module in positions]
+
+
+def stream_rank_modules(student_input, modules: tuple):
+    """
+    Like `rank_modules`, but yields every RankedModule as soon as the model completed it.
+    Cached rankings are yielded at once, streamed ones are cached when complete.
+    """
+    for ranked_module in cached_response_stream(
+        ranking_key(student_input, modules),
+        lambda: (
+            ranked_module.model_dump()
+            for ranked_module in stream_rankings(student_input, modules)
+        ),
+    ):
+        yield RankedModule(**ranked_module)
+
+
+def request_rankings(student_input, modules):
     logging.info("rank_modules")
     try:
-        completion = client.beta.chat.completions.parse(
-            temperature=0,
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful tutor at the help office of TUM university. You will be provided with a list of modules containing fields such as module id, description, language, etc. Also, you will be provided with a message from a student. Please rank the modules according to the student's message. Provide a reason for each module. For the reason please be brief (max 2 sentences). You do not need to repeat the title of the module.",
-                },
-                {"role": "user", "content": f"Student input: {student_input}"},
-                {"role": "user", "content": f"Modules:\n{modules}"},
-            ],
-            response_format=ModuleRankings,
-        )
+        with _ranking_calls:
+            completion = openai_client().beta.chat.completions.parse(
+                temperature=0,
+                model=RANKING_MODEL,
+                messages=ranking_messages(student_input, modules),
+                response_format=ModuleRankings,
+            )
         ranked_modules = completion.choices[0].message.parsed.ranked_modules
     except RateLimitError:
         ranked_modules = []
     return ranked_modules
+
+
+def stream_rankings(student_input, modules):
+    """
+    Requests the ModuleRankings as a stream and parses each ranked module on arrival. Errors
+    (including rate limits) are raised, so a partial ranking is never cached.
+    """
+    logging.info("stream_rank_modules")
+    parser = ArrayItemParser()
+    messages = ranking_messages(student_input, modules)
+    # Counts against RANKING_MAX_CONCURRENT_CALLS until the stream is complete or closed
+    with _ranking_calls, openai_client().beta.chat.completions.stream(
+        temperature=0,
+        model=RANKING_MODEL,
+        messages=messages,
+        response_format=ModuleRankings,
+    ) as stream:
+        for event in stream:
+            if event.type == "content.delta":
+                for item in parser.feed(event.delta):
+                    yield RankedModule(**item)
@@ -0,0 +1,70 @@
+import logging
+from functools import lru_cache
+
+from sqlalchemy import text
+
+from backend.db_models import Session, ModuleServing
+
+# Rebuilds module_serving from the normalized tables: organisation names and ids are
+# joined once, topic and prerequisite lists are aggregated once per module. Only modules
+# with at least one topic are listed, like in apply_filters. Topic and prerequisite filters
+# still look up the mapping tables per module, the lists are only displayed.
+BUILD_MODULE_SERVING = """
+INSERT INTO module_serving (
+    module_id, module_id_uni, name, description, prereq, digital_score, ects, lang,
+    level, org_id, chair, department, school, school_id, department_id, topics,
+    prereq_modules
+)
+SELECT
+    m.module_id, m.module_id_uni, m.name, m.description, m.prereq, m.digital_score,
+    m.ects, m.lang, m.level, m.org_id, o.name, d.name, s.name, o.school_id, d.org_id,
+    t.topics, p.prereq_modules
+FROM modules m
+JOIN (
+    SELECT
+        mtm.module_id,
+        group_concat(DISTINCT tp.topic) AS topics
+    FROM module_topic_mappings mtm
+    JOIN topics tp ON tp.topic_id = mtm.topic_id
+    GROUP BY mtm.module_id
+) t ON t.module_id = m.module_id
+LEFT JOIN organisations o ON o.org_id = m.org_id
+LEFT JOIN organisations d ON d.org_id = o.dep_id
+LEFT JOIN organisations s ON s.org_id = o.school_id
+LEFT JOIN (
+    SELECT
+        module_id_uni,
+        group_concat(DISTINCT prereq_module_id_uni) AS prereq_modules
+    FROM module_prerequisite_mappings
+    GROUP BY module_id_uni
+) p ON p.module_id_uni = m.module_id_uni
+"""
+
+
+def build_module_serving():
+    """Replaces the contents of module_serving. Returns the number of modules written."""
+    with Session() as session:
+        columns = [
+            row[1] for row in session.execute(text("PRAGMA table_info(module_serving)"))
+        ]
+        if columns != [column.name for column in ModuleServing.__table__.columns]:
+            # Created by an older schema (e.g. with the former count columns), recreated
+            # once from the model
+            logging.info("Recreating module_serving with the current columns")
+            session.execute(text("DROP TABLE IF EXISTS module_serving"))
+            ModuleServing.__table__.create(session.connection())
+        session.execute(text("DELETE FROM module_serving"))
+        session.execute(text(BUILD_MODULE_SERVING))
+        session.commit()
+        session.execute(text("ANALYZE module_serving"))
+        return session.query(ModuleServing).count()
+
+
+@lru_cache(maxsize=None)
+def module_serving_available():
+    """Whether the ETL has filled module_serving. Checked once per process."""
+    with Session() as session:
+        available = session.query(ModuleServing.module_id).first() is not None
+    if available:
+        logging.info("Serving module listings from module_serving")
+    return available
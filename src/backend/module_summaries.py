@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import OperationalError
+
+from backend.db_models import Session
+from backend.embeddings import openai_client
+from backend.prompt_budget import count_tokens, truncate_tokens
+
+load_dotenv()
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+# Part of the content hash, bump it whenever the prompt changes to regenerate all summaries
+SUMMARY_PROMPT_VERSION = 1
+# Upper bound of a summary, it replaces the description and prerequisites in the ranking
+# prompt
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 80))
+# Summaries written per transaction, a failed or interrupted run keeps the finished batches
+SUMMARY_BATCH_SIZE = 50
+
+
+def module_source_text(description, prereq):
+    """The module texts a summary stands for."""
+    source = (description or "").strip()
+    if prereq and prereq.strip():
+        source += f"\nPrerequisites: {prereq.strip()}"
+    return source
+
+
+def summary_content_hash(title, description, prereq):
+    """Changes whenever the module texts, the prompt or the summary bound change."""
+    content = json.dumps(
+        [
+            SUMMARY_MODEL,
+            SUMMARY_PROMPT_VERSION,
+            SUMMARY_MAX_TOKENS,
+            title,
+            description or "",
+            prereq or "",
+        ]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def summarize_module(title, description, prereq):
+    """A summary of at most SUMMARY_MAX_TOKENS tokens. Short texts are kept as they are."""
+    source = module_source_text(description, prereq)
+    if count_tokens(source) <= SUMMARY_MAX_TOKENS:
+        return source
+    completion = openai_client().chat.completions.create(
+        temperature=0,
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        messages=[
+            {
+                "role": "system",
+                "content": f"You summarize university module descriptions for a tutor who ranks modules for students. Write at most {SUMMARY_MAX_TOKENS * 3 // 4} English words: what the module teaches and, if stated, the required prior knowledge. Leave out administrative details, teaching methods, exam modalities and the module title.",
+            },
+            {"role": "user", "content": f"Module: {title}\n{source}"},
+        ],
+    )
+    summary = completion.choices[0].message.content or ""
+    return truncate_tokens(summary.strip(), SUMMARY_MAX_TOKENS)
+
+
+def write_module_summaries(rows):
+    with Session() as session:
+        session.execute(
+            text(
+                "INSERT OR REPLACE INTO module_summaries "
+                "(module_id_uni, summary, tokens, content_hash) "
+                "VALUES (:module_id_uni, :summary, :tokens, :content_hash)"
+            ),
+            rows,
+        )
+        session.commit()
+
+
+def build_module_summaries(max_workers=5):
+    """
+    Summarizes every module whose summary is missing or was generated from other texts,
+    and deletes the summaries of modules that no longer exist. A module whose summary
+    fails is logged and skipped, it is retried on the next run. Returns the numbers of
+    written, unchanged and failed summaries.
+    """
+    with Session() as session:
+        modules = session.execute(
+            text("SELECT module_id_uni, name, description, prereq FROM modules")
+        ).fetchall()
+        hashes = dict(
+            session.execute(
+                text("SELECT module_id_uni, content_hash FROM module_summaries")
+            ).fetchall()
+        )
+    stale = [
+        module
+        for module in modules
+        if hashes.get(module[0]) != summary_content_hash(*module[1:])
+    ]
+    logging.info(f"Summarizing {len(stale)} of {len(modules)} modules")
+
+    def summarize(module):
+        summary = summarize_module(*module[1:])
+        return {
+            "module_id_uni": module[0],
+            "summary": summary,
+            "tokens": count_tokens(summary),
+            "content_hash": summary_content_hash(*module[1:]),
+        }
+
+    written, failed, rows = 0, 0, []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(summarize, module): module for module in stale}
+        for future in as_completed(futures):
+            try:
+                rows.append(future.result())
+            except Exception:
+                logging.exception(f"Could not summarize module {futures[future][0]}")
+                failed += 1
+                continue
+            if len(rows) >= SUMMARY_BATCH_SIZE:
+                write_module_summaries(rows)
+                written += len(rows)
+                rows = []
+    if rows:
+        write_module_summaries(rows)
+        written += len(rows)
+    with Session() as session:
+        session.execute(
+            text(
+                "DELETE FROM module_summaries WHERE module_id_uni NOT IN "
+                "(SELECT module_id_uni FROM modules)"
+            )
+        )
+        session.commit()
+    return written, len(modules) - len(stale), failed
+
+
+def module_summaries(modules):
+    """
+    {module id: summary} for the module dicts (with title, description and prereq) whose
+    stored summary was generated from their current texts.
+    """
+    module_ids = [module["id"] for module in modules]
+    if not module_ids:
+        return {}
+    try:
+        with Session() as session:
+            rows = session.execute(
+                text(
+                    "SELECT module_id_uni, summary, content_hash FROM module_summaries "
+                    "WHERE module_id_uni IN :module_ids"
+                ).bindparams(bindparam("module_ids", expanding=True)),
+                {"module_ids": module_ids},
+            ).fetchall()
+    except OperationalError as error:
+        # E.g. the migration creating module_summaries was not applied
+        logging.warning(f"No module summaries: {error}")
+        return {}
+    stored = {row[0]: row[1:] for row in rows}
+    summaries = {}
+    for module in modules:
+        summary, content_hash = stored.get(module["id"], (None, None))
+        if content_hash == summary_content_hash(
+            module.get("title"), module.get("description"), module.get("prereq")
+        ):
+            summaries[module["id"]] = summary
+    return summaries
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.embeddings import EMBEDDING_MODEL, cached_embed_texts
+
+load_dotenv()
+
+# Embeddings of every module's title and description, stored next to the database:
+#   <base>.json   embedding model, checksum of the embedded texts and the module_id_uni of
+#                 every row
+#   <base>.npy    float32 (n, d) matrix of L2-normalized vectors, memory-mapped on load
+MODULE_VECTORS_PATH = os.getenv("MODULE_VECTORS_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DB_PATH", "modules.db"))),
+    "module_vectors",
+)
+# Long descriptions are cut, the beginning says what a module is about
+MODULE_TEXT_MAX_CHARS = 4000
+
+
+def module_texts(catalog):
+    """The text embedded for every module of `catalog`, in catalog order."""
+    return [
+        f"{title}\n{description or ''}"[:MODULE_TEXT_MAX_CHARS]
+        for title, description in zip(catalog.title, catalog.description)
+    ]
+
+
+def module_texts_checksum(module_ids, texts, model=EMBEDDING_MODEL):
+    checksum = hashlib.sha256(model.encode())
+    for module_id, text in zip(module_ids, texts):
+        checksum.update(json.dumps([module_id, text]).encode())
+    return checksum.hexdigest()
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def compute_module_vectors(texts, batch_size=256, model=EMBEDDING_MODEL):
+    """Embeds `texts` in batches through the embedding cache, returns normalized rows."""
+    batches = [
+        cached_embed_texts(texts[start : start + batch_size], model=model)
+        for start in range(0, len(texts), batch_size)
+    ]
+    return normalize_rows(np.concatenate(batches)) if batches else None
+
+
+def write_module_vectors(module_ids, vectors, checksum, path=MODULE_VECTORS_PATH):
+    with open(f"{path}.npy.tmp", "wb") as file:
+        np.save(file, np.asarray(vectors, dtype=np.float32))
+    os.replace(f"{path}.npy.tmp", f"{path}.npy")
+    with open(f"{path}.json.tmp", "w") as file:
+        json.dump(
+            {
+                "model": EMBEDDING_MODEL,
+                "checksum": checksum,
+                "moduleIds": list(module_ids),
+            },
+            file,
+        )
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+
+
+def load_module_vectors(path=MODULE_VECTORS_PATH, checksum=None):
+    """
+    Maps the module vectors. Returns None if they are missing or were computed from other
+    module texts than `checksum`.
+    """
+    try:
+        with open(f"{path}.json") as file:
+            meta = json.load(file)
+        if checksum is not None and meta["checksum"] != checksum:
+            logging.info("Module vectors are stale, not pre-ranking with them")
+            return None
+        return ModuleVectors(
+            meta["moduleIds"], np.load(f"{path}.npy", mmap_mode="r"), meta["model"]
+        )
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+        return None
+
+
+class ModuleVectors:
+    def __init__(self, module_ids, vectors, model=EMBEDDING_MODEL):
+        self.rows = {module_id: row for row, module_id in enumerate(module_ids)}
+        self.vectors = vectors
+        self.model = model
+
+    def scores(self, query_vector, module_ids):
+        """
+        Cosine similarity of `query_vector` to each module in `module_ids`, -inf for modules
+        without a vector.
+        """
+        rows = np.asarray(
+            [self.rows.get(module_id, -1) for module_id in module_ids], dtype=np.int64
+        )
+        scores = np.full(len(rows), -np.inf, dtype=np.float32)
+        known = rows >= 0
+        if known.any():
+            scores[known] = self.vectors[rows[known]] @ normalize_rows(query_vector)
+        return scores
+
+    def prerank(self, text, modules, top_n):
+        """
+        Orders the module dicts by the cosine similarity of their vectors to the embedded
+        `text`, ties and modules without a vector keep their order. Returns the top_n
+        closest modules and the rest.
+        """
+        query_vector = cached_embed_texts([text], model=self.model)[0]
+        scores = self.scores(query_vector, [module["id"] for module in modules])
+        order = np.argsort(-scores, kind="stable")
+        ranked = [modules[position] for position in order.tolist()]
+        return ranked[:top_n], ranked[top_n:]
+
+
+def catalog_module_vectors(catalog):
+    """Loads the module vectors if they were computed from the modules of `catalog`."""
+    return load_module_vectors(
+        checksum=module_texts_checksum(catalog.module_id_uni, module_texts(catalog))
+    )
@@ -0,0 +1,60 @@
+import logging
+import math
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Without tiktoken (or its encoding files) tokens are estimated from the text length
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def encoding(model):
+    """The tiktoken encoding of `model`, or None if tiktoken or its encoding is unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as error:
+        # E.g. an unknown model or no network to download the encoding once
+        logging.warning(f"No tokenizer for {model}, estimating tokens: {error}")
+        return None
+
+
+def count_tokens(text, model="gpt-4o"):
+    tokenizer = encoding(model)
+    if tokenizer is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(tokenizer.encode(text))
+
+
+def truncate_tokens(text, max_tokens, model="gpt-4o"):
+    """Cuts `text` to at most `max_tokens` tokens, at a word boundary if estimated."""
+    if max_tokens <= 0:
+        return ""
+    tokenizer = encoding(model)
+    if tokenizer is None:
+        if len(text) <= max_tokens * CHARS_PER_TOKEN:
+            return text
+        cut = text[: max_tokens * CHARS_PER_TOKEN]
+        return cut.rsplit(" ", 1)[0] if " " in cut else cut
+    tokens = tokenizer.encode(text)
+    return text if len(tokens) <= max_tokens else tokenizer.decode(tokens[:max_tokens])
+
+
+def allocate_tokens(sizes, budget):
+    """
+    The largest per-item cap such that sum(min(size, cap)) fits into `budget`: items below
+    the cap keep all their tokens and leave the rest of their share to the longer ones.
+    """
+    remaining = max(budget, 0)
+    sizes = sorted(sizes)
+    for index, size in enumerate(sizes):
+        share = remaining // (len(sizes) - index)
+        if size > share:
+            return share
+        remaining -= size
+    return sizes[-1] if sizes else 0
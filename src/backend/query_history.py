@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from backend.db_models import Session
+from backend.module_filter import cached_module_ids, filter_cache, filters_json
+
+load_dotenv()
+
+# Replay of the logged requests on start, so the first users after a deploy hit warm caches.
+# The replay stops at whichever budget is used up first.
+WARMUP_TIME_BUDGET = float(os.getenv("WARMUP_TIME_BUDGET", 30))
+# Bytes the replayed filter results may add to the filter cache
+WARMUP_MEMORY_BUDGET = int(os.getenv("WARMUP_MEMORY_BUDGET", 8 * 2**20))
+WARMUP_FILTERS = int(os.getenv("WARMUP_FILTERS", 500))
+# Only filter combinations requested within this many days are replayed
+WARMUP_WINDOW_DAYS = float(os.getenv("WARMUP_WINDOW_DAYS", 7))
+# Every replayed student text is an LLM request, so they are only replayed on request
+WARMUP_STUDENT_TEXTS = int(os.getenv("WARMUP_STUDENT_TEXTS", 0))
+# Seconds between the batched writes of the requested filter counts
+FILTER_LOG_FLUSH_INTERVAL = float(os.getenv("FILTER_LOG_FLUSH_INTERVAL", 30))
+
+# {filters JSON: (hits, last seen)} not yet written to filter_queries
+_pending_filters = {}
+_pending_lock = threading.Lock()
+_filter_log_flusher = None
+
+
+def log_filters(filters):
+    """
+    Counts a request for the filters of `apply_filters`. The counts are buffered in memory
+    and written to filter_queries in batches by a background thread, so requests never
+    wait for the write lock of the database.
+    """
+    key = filters_json(filters)
+    with _pending_lock:
+        hits, _ = _pending_filters.get(key, (0, None))
+        _pending_filters[key] = (hits + 1, time.time())
+    _start_filter_log_flusher()
+
+
+def flush_filter_log():
+    """Writes the buffered filter counts in one transaction. Returns the rows written."""
+    global _pending_filters
+    with _pending_lock:
+        pending, _pending_filters = _pending_filters, {}
+    if not pending:
+        return 0
+    session = Session()
+    try:
+        session.execute(
+            text(
+                "INSERT INTO filter_queries (filters, hits, last_seen) "
+                "VALUES (:filters, :hits, :last_seen) "
+                "ON CONFLICT (filters) DO UPDATE "
+                "SET hits = hits + excluded.hits, last_seen = excluded.last_seen"
+            ),
+            [
+                {"filters": filters, "hits": hits, "last_seen": last_seen}
+                for filters, (hits, last_seen) in pending.items()
+            ],
+        )
+        session.commit()
+    except OperationalError as error:
+        # E.g. the migration creating filter_queries was not applied, the counts are only
+        # used to warm caches and are dropped
+        logging.warning(f"Could not log {len(pending)} filter combinations: {error}")
+        session.rollback()
+        return 0
+    finally:
+        session.close()
+    return len(pending)
+
+
+def _start_filter_log_flusher():
+    global _filter_log_flusher
+    if _filter_log_flusher is not None:
+        return
+    with _pending_lock:
+        if _filter_log_flusher is None:
+            _filter_log_flusher = threading.Thread(
+                target=_flush_filter_log_periodically, name="filter-log", daemon=True
+            )
+            _filter_log_flusher.start()
+            # The last batch is written on a regular shutdown
+            atexit.register(flush_filter_log)
+
+
+def _flush_filter_log_periodically():
+    while True:
+        time.sleep(FILTER_LOG_FLUSH_INTERVAL)
+        try:
+            flush_filter_log()
+        except Exception:
+            logging.exception("Flushing the filter log failed")
+
+
+def top_filters(limit=WARMUP_FILTERS, window_days=WARMUP_WINDOW_DAYS):
+    """The most requested filter combinations of the last `window_days`, as tuples."""
+    with Session() as session:
+        rows = session.execute(
+            text(
+                "SELECT filters FROM filter_queries WHERE last_seen >= :since "
+                "ORDER BY hits DESC, last_seen DESC LIMIT :limit"
+            ),
+            {"since": time.time() - window_days * 86400, "limit": limit},
+        ).fetchall()
+    return [
+        tuple(
+            tuple(value) if isinstance(value, list) else value
+            for value in json.loads(row[0])
+        )
+        for row in rows
+    ]
+
+
+def recent_student_texts(limit):
+    """The last `limit` student texts stored by /modules-ranked."""
+    if limit <= 0:
+        return []
+    with Session() as session:
+        rows = session.execute(
+            text("SELECT text FROM user_input ORDER BY rowid DESC LIMIT :limit"),
+            {"limit": limit},
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def replay_query_history(
+    extract_preferences=None,
+    time_budget=WARMUP_TIME_BUDGET,
+    memory_budget=WARMUP_MEMORY_BUDGET,
+    filters_limit=WARMUP_FILTERS,
+    student_texts_limit=WARMUP_STUDENT_TEXTS,
+):
+    """
+    Replays the most requested recent filter combinations through the filter cache and, if
+    `student_texts_limit` is set, extracts the most recent student texts with
+    `extract_preferences(text)`, which also maps their raw topics. Returns the number of
+    warmed keys per stage for /ready.
+    """
+    deadline = time.perf_counter() + time_budget
+    report = {
+        "filters": 0,
+        "studentTexts": 0,
+        "bytes": 0,
+        "stoppedBy": None,
+    }
+    try:
+        history = top_filters(filters_limit)
+        student_texts = recent_student_texts(student_texts_limit)
+    except OperationalError as error:
+        logging.warning(f"No query history to replay: {error}")
+        return report
+
+    cache = filter_cache()
+    for filters in history:
+        if time.perf_counter() > deadline:
+            report["stoppedBy"] = "time"
+            break
+        size = cache.size
+        try:
+            cached_module_ids(*filters)
+        except Exception as error:
+            # E.g. a school or department renamed since the combination was logged
+            logging.warning(f"Skipping logged filters {filters}: {error}")
+            continue
+        report["bytes"] += max(cache.size - size, 0)
+        report["filters"] += 1
+        if report["bytes"] >= memory_budget:
+            report["stoppedBy"] = "memory"
+            break
+
+    # The topics of logged filters are catalog names that the precomputed topic neighbours
+    # answer without an embedding, so only student texts warm the topic mapping
+    if extract_preferences:
+        for student_text in student_texts:
+            if time.perf_counter() > deadline:
+                report["stoppedBy"] = "time"
+                break
+            try:
+                extract_preferences(student_text)
+            except Exception:
+                logging.exception("Replaying a student text failed")
+                continue
+            report["studentTexts"] += 1
+
+    logging.info(f"Replayed query history: {report}")
+    return report
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+from backend.embeddings import normalize_text
+from backend.sqlite_cache import SqliteCache
+
+load_dotenv()
+
+# LLM responses (module rankings, extracted preferences) are cached in their own SQLite
+# file next to the database, shared by all workers and kept across restarts
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DB_PATH", "modules.db"))),
+    "response_cache.db",
+)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 2**20))
+# Responses are answered again after a week, e.g. once module descriptions changed
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+
+
+@lru_cache(maxsize=None)
+def response_cache():
+    return SqliteCache(
+        RESPONSE_CACHE_PATH,
+        "responses",
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+    )
+
+
+def response_key(kind, model, prompt_version, student_text, module_ids=()):
+    """
+    Content address of an LLM response: texts that only differ in case or whitespace and
+    the same candidates in any order share one entry. Bump `prompt_version` whenever the
+    prompt or the response schema changes.
+    """
+    content = json.dumps(
+        [model, prompt_version, normalize_text(student_text), sorted(module_ids)]
+    )
+    return f"{kind}:{hashlib.sha256(content.encode()).hexdigest()}"
+
+
+def cached_response(key, compute):
+    """
+    Returns the JSON response cached under `key`, or computes, caches and returns it.
+    Empty responses (e.g. after a rate limit) are not cached.
+    """
+    cache = response_cache()
+    blob = cache.get(key)
+    if blob is not None:
+        return json.loads(blob)
+    response = compute()
+    if response:
+        cache.set(key, json.dumps(response).encode())
+    return response
+
+
+def cached_response_stream(key, compute):
+    """
+    Like `cached_response` for list responses that `compute` produces item by item: yields
+    the cached items, or every computed item as it arrives and caches the complete list.
+    """
+    cache = response_cache()
+    blob = cache.get(key)
+    if blob is not None:
+        yield from json.loads(blob)
+        return
+    response = []
+    for item in compute():
+        response.append(item)
+        yield item
+    if response:
+        cache.set(key, json.dumps(response).encode())
@@ -1,48 +1,124 @@
+import json
 import logging
+import os
 from functools import lru_cache
 from typing import Dict
 from rapidfuzz import fuzz
 import re
 
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, jsonify, request
 from flask_cors import CORS
+from openai import OpenAIError
 from sqlalchemy import or_, text
 
 from backend.db_models import Session, Module
 from backend.module_filter import (
-    apply_filters,
+    apply_filters_page,
+    facet_counts,
+    module_catalog,
     modules_by_id,
+    resolve_fields,
 )
-from backend.module_ranker import rank_modules
+from backend.module_ranker import rank_modules_sharded, stream_rank_modules
+from backend.module_vectors import catalog_module_vectors
+from backend.query_history import log_filters, replay_query_history
 from backend.student_input_extraction import extract_student_preferences
 from backend.topic_mapper import VectorStore
+from backend.warmup import LazyResource, readiness, start_warmup
 
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
-vectorstore = VectorStore()
+# Warm heavy singletons in the background when create_app() is called (0 for tests / CLIs)
+WARM_UP_ON_START = os.getenv("WARM_UP_ON_START", "1") == "1"
+
+api = Blueprint("api", __name__)
+# Built in the background on start, or on first use
+vectorstore = LazyResource("vectorstore", VectorStore)
+# The catalog serves /modules/facets and builds the listed modules, and with the default
+# MODULE_FILTER_ENGINE=catalog it also runs the filters
+WARMUP_RESOURCES = [vectorstore, LazyResource("module_catalog", module_catalog)]
+# None until scripts/09_embed_modules.py embedded the current modules
+module_vectors = LazyResource(
+    "module_vectors", lambda: catalog_module_vectors(module_catalog())
+)
+WARMUP_RESOURCES.append(module_vectors)
+# Replays the most requested recent filters (and opt-in student texts) into the caches
+query_history = LazyResource(
+    "query_history",
+    lambda: replay_query_history(
+        extract_preferences=extract_and_process_user_preferences
+    ),
+    report=lambda report: report,
+)
+# Only pre-warm caches: reported by /ready, but the app is ready without them
+CACHE_WARMUP_RESOURCES = [query_history]
+# Modules fetched for /modules-ranked (at least the page size), pre-ranked locally
+RANKING_CANDIDATES = int(os.getenv("RANKING_CANDIDATES", 20))
+# Candidates sent to the LLM after pre-ranking them by embedding similarity. More than
+# RANKING_SHARD_SIZE candidates are ranked in concurrent shards (see module_ranker.py), so
+# with the defaults a single call ranks them. To rank 50-100 candidates in shards set e.g.
+# RANKING_CANDIDATES=100 and PRERANK_TOP_N=100.
+PRERANK_TOP_N = int(os.getenv("PRERANK_TOP_N", 10))
+# Module fields the LLM ranks on, fetched for /modules-ranked whatever the projection
+RANKING_FIELDS = (
+    "id",
+    "title",
+    "description",
+    "prereq",
+    "ects",
+    "language",
+    "studyLevel",
+    "chair",
+    "department",
+    "school",
+)
 MODULE_ID_UNI_PATTERN = re.compile(
     r"(?:\W|^)([A-Z]{2,4}[0-9]{3,7}|BGU[0-9A-Z]{5,8}|MW[0-9A-Z]{5}|CH-C[0-9]{2}|BV[0-9]{6}T[0-9]|CS[0-9]{4}BOK|WZ[0-9]{4}BOK|CITHN[0-9]{4,5}|MGTHN[0-9]{4,5}|SG[0-9]{6}(?:e|a|BNB|BBB|VHB|v2)?)(?:\W|$)"
 )
 
 
+def create_app(warm_up=WARM_UP_ON_START):
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(api)
+    if warm_up:
+        start_warmup(WARMUP_RESOURCES + CACHE_WARMUP_RESOURCES)
+    return app
+
+
+@api.get("/ready")
+def ready():
+    """
+    Readiness probe: 200 once every heavy singleton is warmed up, 503 until then. The cache
+    warm-up is reported under "cacheWarmup" and does not hold readiness back.
+    """
+    # A probe also starts warming, in case the app was created without warm-up
+    start_warmup(WARMUP_RESOURCES + CACHE_WARMUP_RESOURCES)
+    is_ready, resources = readiness(WARMUP_RESOURCES)
+    _, cache_warmup = readiness(CACHE_WARMUP_RESOURCES)
+    status = 200 if is_ready else 503
+    response = {"ready": is_ready, "resources": resources, "cacheWarmup": cache_warmup}
+    return jsonify(response), status
+
+
 def add_reasoning(module_ranks, modules):
+    """
+    Returns copies of `modules` in the LLM's rank order with its reasoning added, the
+    passed modules are left unchanged.
+    """
     # Step 1: Create a mapping of module_id to reasoning
     reasoning_map = {module.module_id: module.reasoning for module in module_ranks}
 
     order_map = {module.module_id: index for index, module in enumerate(module_ranks)}
 
-    modules.sort(key=lambda m: order_map.get(m["id"], float("inf")))
+    ranked_modules = sorted(modules, key=lambda m: order_map.get(m["id"], float("inf")))
 
-    # Step 2: Update paginated modules with the reasoning field
-    for module in modules:
-        module_id = module.get("id")
-        if module_id in reasoning_map.keys():
-            module["reasoning"] = reasoning_map[module_id]
-        else:
-            module["reasoning"] = None
+    # Step 2: Copy the modules with the reasoning field
+    return [
+        {**module, "reasoning": reasoning_map.get(module.get("id"))}
+        for module in ranked_modules
+    ]
 
 
 def store_user_input(input):
@@ -55,11 +131,14 @@ def store_user_input(input):
     session.close()
 
 
-@app.get("/modules")
+@api.get("/modules")
 def get_modules():
     """Fetch unranked modules based on filter parameters."""
     # Extract query parameters
-    query_params = extract_query_params()
+    try:
+        query_params = extract_query_params()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
 
     # Fetch unranked modules
     paginated_modules, total_pages, total_modules = fetch_unranked_modules(query_params)
@@ -75,11 +154,14 @@ def get_modules():
     )
 
 
-@app.get("/modules-ranked")
+@api.get("/modules-ranked")
 def get_modules_ranked():
     """Fetch ranked modules based on filter parameters and student text."""
     # Extract query parameters
-    query_params = extract_query_params()
+    try:
+        query_params = extract_query_params()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
 
     # Fetch ranked modules
     paginated_modules, modules_ranked_by_llm, total_pages, total_modules = (
@@ -98,10 +180,21 @@ def get_modules_ranked():
     )
 
 
-def fetch_unranked_modules(query_params):
-    """Fetch and paginate unranked modules based on filter parameters."""
-    # Separate filter parameters from others
-    filter_params = {
+@api.get("/modules/facets")
+def get_module_facets():
+    """Count the modules per filter option for the current filter state."""
+    try:
+        query_params = extract_query_params()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+
+    # Each facet ignores its own filter, so its counts are what selecting an option returns
+    return jsonify({"facets": facet_counts(**filter_params_of(query_params))})
+
+
+def filter_params_of(query_params):
+    """Separate filter parameters from others."""
+    return {
         key: query_params[key]
         for key in [
             "schools",
@@ -118,67 +211,48 @@ def fetch_unranked_modules(query_params):
         ]
     }
 
-    # Apply filters to fetch modules
-    filtered_modules = apply_filters(**filter_params)
 
-    # Paginate the filtered modules
-    paginated_modules, total_pages, total_modules = paginate(
-        filtered_modules, query_params["page"], query_params["size"]
+def fetch_unranked_modules(query_params):
+    """Fetch and paginate unranked modules based on filter parameters."""
+    filter_params = filter_params_of(query_params)
+
+    # Only the requested page is fetched, the total comes from a separate count
+    size = query_params["size"]
+    paginated_modules, total_modules = apply_filters_page(
+        **filter_params,
+        page=query_params["page"],
+        size=size,
+        fields=query_params["fields"],
     )
+    # Logged once the filters resolved, invalid requests are not replayed on start
+    log_filters(tuple(filter_params.values()))
+    total_pages = (total_modules + size - 1) // size
 
     return paginated_modules, total_pages, total_modules
 
 
 def fetch_ranked_modules(query_params):
     """Fetch, rank, and paginate modules based on filter parameters and student text."""
-    # Fetch a larger set of unranked modules first to ensure there are enough for ranking
     original_page_size = query_params["size"]
-    larger_page_size = max(
-        query_params["size"], 20
-    )  # Ensure at least 40 modules are fetched
-    query_params["size"] = larger_page_size
+    requested_fields = query_params["fields"]
+    candidates, remaining, total_modules = fetch_ranking_candidates(query_params)
 
-    # Fetch unranked modules with a larger page size
-    all_modules, _, total_modules = fetch_unranked_modules(query_params)
-    print(len(all_modules))
     # If student text is provided, rank the modules using LLM
     modules_ranked_by_llm = None
-    if all_modules and query_params["student_text"]:
-        store_user_input(query_params["student_text"])
-
-        modules_filtererd_fields = [
-            {
-                key: module[key]
-                for key in [
-                    "id",
-                    "title",
-                    "description",
-                    "prereq",
-                    "ects",
-                    "language",
-                    "studyLevel",
-                    "chair",
-                    "department",
-                    "school",
-                ]
-            }
-            for module in all_modules
-        ]
-
-        # Use all fetched modules for ranking to optimize performance
-        module_ranks = rank_modules(
-            student_input=query_params["student_text"],
-            modules=tuple(
-                frozenset(
-                    (k, tuple(v) if isinstance(v, list) else v)
-                    for k, v in module.items()
-                )
-                for module in modules_filtererd_fields
-            ),
-        )
+    if candidates and query_params["student_text"]:
+        try:
+            module_ranks = rank_modules_sharded(
+                student_input=query_params["student_text"],
+                modules=ranking_input(candidates),
+            )
+        except OpenAIError:
+            logging.exception("Ranking with the LLM failed, using the local order")
+            module_ranks = None
         if module_ranks:
             # Add reasoning to the ranked modules
-            add_reasoning(module_ranks, all_modules)
+            all_modules = add_reasoning(module_ranks, candidates) + [
+                {**module, "reasoning": None} for module in remaining
+            ]
             print(f"{module_ranks=}")
             # Paginate the ranked modules after adding reasoning
             paginated_modules, total_pages, _ = paginate(
@@ -187,17 +261,147 @@ def fetch_ranked_modules(query_params):
             modules_ranked_by_llm = paginated_modules
         else:
             paginated_modules, total_pages, _ = paginate(
-                all_modules, query_params["page"], original_page_size
+                candidates + remaining, query_params["page"], original_page_size
             )
     else:
         # No ranking needed, paginate the unranked modules
         paginated_modules, total_pages, _ = paginate(
-            all_modules, query_params["page"], original_page_size
+            candidates + remaining, query_params["page"], original_page_size
         )
 
+    paginated_modules = project_modules(paginated_modules, requested_fields)
+    if modules_ranked_by_llm is not None:
+        modules_ranked_by_llm = paginated_modules
     return paginated_modules, modules_ranked_by_llm, total_pages, total_modules
 
 
+def fetch_ranking_candidates(query_params):
+    """
+    Fetches the modules to rank for the student text. Returns the candidates for the LLM,
+    the remaining modules in local order and the total number of matching modules.
+    """
+    # Fetch a larger set of unranked modules first to ensure there are enough for ranking
+    query_params = dict(query_params)
+    # The LLM needs the ranking fields, the response only the requested ones
+    query_params["fields"] = resolve_fields(query_params["fields"] + RANKING_FIELDS)
+    larger_page_size = max(
+        query_params["size"], RANKING_CANDIDATES
+    )  # Ensure at least RANKING_CANDIDATES modules are fetched
+    query_params["size"] = larger_page_size
+
+    # Fetch unranked modules with a larger page size
+    all_modules, _, total_modules = fetch_unranked_modules(query_params)
+    print(len(all_modules))
+    if not all_modules or not query_params["student_text"]:
+        return all_modules, [], total_modules
+    store_user_input(query_params["student_text"])
+
+    # Only the candidates closest to the student text go to the LLM, the others
+    # follow in the local order, which is also the answer if the LLM is unavailable
+    try:
+        candidates, remaining = prerank_modules(
+            query_params["student_text"], all_modules
+        )
+    except OpenAIError:
+        logging.exception("Pre-ranking failed, sending all modules to the LLM")
+        candidates, remaining = all_modules, []
+    return candidates, remaining, total_modules
+
+
+def ranking_input(modules):
+    """The ranking fields of `modules` as hashable (field, value) pairs for the LLM."""
+    return tuple(
+        frozenset(
+            (key, tuple(module[key]) if isinstance(module[key], list) else module[key])
+            for key in RANKING_FIELDS
+        )
+        for module in modules
+    )
+
+
+@api.get("/modules-ranked/stream")
+def stream_modules_ranked():
+    """
+    Stream the LLM ranking as server-sent events: the fetched modules in local order first,
+    then every ranked module with its reasoning as soon as the model completed it.
+    """
+    try:
+        query_params = extract_query_params()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    if not query_params["student_text"]:
+        return jsonify({"message": "studentText is required"}), 400
+
+    requested_fields = query_params["fields"]
+    candidates, remaining, total_modules = fetch_ranking_candidates(query_params)
+
+    def events():
+        yield server_sent_event(
+            "modules",
+            {
+                "modules": project_modules(candidates + remaining, requested_fields),
+                "totalModules": total_modules,
+            },
+        )
+        unranked = {module["id"]: module for module in candidates}
+        rank = 0
+        try:
+            for ranked_module in stream_rank_modules(
+                query_params["student_text"], ranking_input(candidates)
+            ):
+                # Skips ids the model made up or repeated
+                module = unranked.pop(ranked_module.module_id, None)
+                if module is None:
+                    continue
+                module = {**module, "reasoning": ranked_module.reasoning}
+                yield server_sent_event(
+                    "ranked",
+                    {
+                        "rank": rank,
+                        "module": project_modules([module], requested_fields)[0],
+                    },
+                )
+                rank += 1
+        except OpenAIError:
+            logging.exception("Streaming the ranking failed")
+            yield server_sent_event("error", {"message": "Ranking failed"})
+        yield server_sent_event("done", {"rankedModules": rank})
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        # Proxies must not buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def prerank_modules(student_text, modules):
+    """
+    Splits `modules` into the PRERANK_TOP_N closest to the student text and the rest, both
+    ordered by similarity. Without module vectors all modules are candidates.
+    """
+    vectors = module_vectors.get()
+    if vectors is None:
+        return modules, []
+    return vectors.prerank(student_text, modules, PRERANK_TOP_N)
+
+
+def project_modules(modules, fields):
+    """Drops every key that is not in `fields` (the LLM reasoning is kept)."""
+    return [
+        {
+            key: value
+            for key, value in module.items()
+            if key in fields or key == "reasoning"
+        }
+        for module in modules
+    ]
+
+
 def extract_query_params():
     """Extracts and processes query parameters for filtering and pagination."""
     ects_range = request.args.getlist("ectsRange[]", type=int)
@@ -218,6 +422,10 @@ def extract_query_params():
         "topics_of_interest": tuple(request.args.getlist("topicsOfInterest[]")),
         "excluded_topics": tuple(request.args.getlist("excludedTopics[]")),
         "schools": tuple(request.args.getlist("schools[]")),
+        # Either fields[]=id&fields[]=title or a named projection such as summary / full
+        "fields": resolve_fields(
+            tuple(request.args.getlist("fields[]")), request.args.get("projection")
+        ),
         "student_text": request.args.get("studentText", ""),
         "page": request.args.get("page", type=int, default=1),
         "size": request.args.get("size", type=int, default=5),
@@ -234,7 +442,7 @@ def paginate(filtered_modules, page, size):
     return paginated_modules, total_pages, total_modules
 
 
-@app.get("/modules-by-id")
+@api.get("/modules-by-id")
 def get_modules_by_id():
     module_ids = tuple(request.args.getlist("moduleIds[]"))
     modules = modules_by_id(module_ids=module_ids)
@@ -249,13 +457,15 @@ def get_modules_by_id():
     )
 
 
-def get_topic_mappings(topic, k=30, threshold=0.23):
-    topic_mappings = vectorstore.map_topic(topic, k=k, threshold=threshold)
+def get_topic_mappings(topic, k=30, threshold=0.23, range_search=False):
+    topic_mappings = vectorstore.map_topic(
+        topic, k=k, threshold=threshold, range_search=range_search
+    )
     topic_mappings = [mapping.topic for mapping in topic_mappings]
     return topic_mappings
 
 
-@app.route("/map-topic", methods=["GET"])
+@api.route("/map-topic", methods=["GET"])
 def map_topic():
     topic = request.args.get("topic")
     if not topic:
@@ -263,8 +473,15 @@ def map_topic():
 
     # threshold = request.args.get("threshold", default=0.23, type=float)
     threshold = request.args.get("threshold", default=0.5, type=float)
-    max_mappings = request.args.get("maxMappings", default=100, type=int)
-    topic_mappings = get_topic_mappings(topic, k=max_mappings, threshold=threshold)
+    # In range search mode all topics within the threshold are returned and maxMappings is
+    # an optional cap, otherwise maxMappings is the number of neighbours searched
+    range_search = request.args.get("searchMode", default="knn") == "range"
+    max_mappings = request.args.get(
+        "maxMappings", default=None if range_search else 100, type=int
+    )
+    topic_mappings = get_topic_mappings(
+        topic, k=max_mappings, threshold=threshold, range_search=range_search
+    )
     print(topic_mappings)
     return jsonify({"topicMappings": topic_mappings}), 200
 
@@ -282,7 +499,7 @@ def compute_similarity_score(title_a, title_b):
     return score
 
 
-@app.get("/search-modules")
+@api.get("/search-modules")
 def search_modules():
     query = request.args.get("query", "")
     limit = request.args.get("limit", type=int, default=10)
@@ -315,7 +532,7 @@ def search_modules():
     return jsonify({"modules": modules})
 
 
-@app.post("/start-extraction")
+@api.post("/start-extraction")
 def start_extraction():
     data = request.get_json()
     if not data or "text" not in data:
@@ -330,8 +547,8 @@ def start_extraction():
     # return jsonify({"success": False, "message": str(e)}), 500
 
 
-@lru_cache
 def extract_and_process_user_preferences(student_input):
+    # The extraction is cached on disk, mapping and matching are redone for the current data
     prefs = extract_student_preferences(student_input=student_input)
     logging.info("Parsing extracted prefs ...")
     prefs_processed = post_process_prefs(prefs)
@@ -339,16 +556,22 @@ def extract_and_process_user_preferences(student_input):
 
 
 def post_process_prefs(prefs: Dict):
-    new_topics_of_interest = {
-        topic: get_topic_mappings(topic, k=30, threshold=0.23)
-        for topic in prefs["topicsOfInterest"]
-    }
-    new_topics_to_exclude = {
-        topic: get_topic_mappings(topic, k=10, threshold=0.15)
-        for topic in prefs["topicsToExclude"]
-    }
-    prefs["topicsOfInterest"] = new_topics_of_interest
-    prefs["topicsToExclude"] = new_topics_to_exclude
+    topics_of_interest = list(prefs["topicsOfInterest"])
+    topics_to_exclude = list(prefs["topicsToExclude"])
+    # Map all topics with a single embeddings request and index search
+    topic_mappings = [
+        [mapping.topic for mapping in mappings]
+        for mappings in vectorstore.map_topics_batched(
+            [(topic, 30, 0.23) for topic in topics_of_interest]
+            + [(topic, 10, 0.15) for topic in topics_to_exclude]
+        )
+    ]
+    prefs["topicsOfInterest"] = dict(
+        zip(topics_of_interest, topic_mappings[: len(topics_of_interest)])
+    )
+    prefs["topicsToExclude"] = dict(
+        zip(topics_to_exclude, topic_mappings[len(topics_of_interest) :])
+    )
     session = Session()
     previous_module_ids_and_titles = (
         session.query(Module.module_id_uni, Module.name)
@@ -384,5 +607,8 @@ def post_process_prefs(prefs: Dict):
     return prefs
 
 
+# Importing this module builds nothing, the entry points create the app:
+#   flask --app backend.routes run          (Flask finds create_app)
+#   gunicorn "backend.routes:create_app()"
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=8080)
+    create_app().run(debug=True, host="0.0.0.0", port=8080)
@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+
+
+class SqliteCache:
+    """
+    Byte-budgeted key-value cache stored in a SQLite file. Several worker processes can share
+    the same file, entries survive restarts, and the least recently used entries are evicted
+    once the stored values exceed `max_bytes`. With a `ttl` (seconds) entries also expire
+    that long after they were written.
+    Hit and miss counters are kept per process.
+    """
+
+    def __init__(self, path, table, max_bytes, ttl=None):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "last_used REAL NOT NULL, expires_at REAL)"
+            )
+            columns = {
+                row[1] for row in connection.execute(f"PRAGMA table_info({self.table})")
+            }
+            if "expires_at" not in columns:
+                # Cache files written before entries could expire
+                connection.execute(
+                    f"ALTER TABLE {self.table} ADD COLUMN expires_at REAL"
+                )
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_last_used "
+                f"ON {self.table} (last_used, size)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns {key: value} for all keys that are cached."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        # Stay below SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                self.connection.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders}) "
+                    "AND (expires_at IS NULL OR expires_at > ?)",
+                    [*chunk, now],
+                ).fetchall()
+            )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        if found:
+            with self.connection:
+                self.connection.executemany(
+                    f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} "
+                "(key, value, size, last_used, expires_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, value, len(value), now, expires_at)
+                    for key, value in items.items()
+                ],
+            )
+        self.evict()
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def evict(self):
+        """
+        Drops expired entries, then the least recently used entries until the cache fits
+        into `max_bytes`.
+        """
+        with self.connection:
+            self.connection.execute(
+                f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),)
+            )
+            self.connection.execute(
+                f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (
+                            ORDER BY last_used DESC, key
+                        ) AS running_size
+                        FROM {self.table}
+                    ) WHERE running_size > ?
+                )
+                """,
+                (self.max_bytes,),
+            )
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {self.table}")
+
+    def stats(self):
+        entries, size = self.connection.execute(
+            f"SELECT COUNT(*), TOTAL(size) FROM {self.table}"
+        ).fetchone()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / requests if requests else None,
+            "entries": entries,
+            "bytes": int(size),
+            "maxBytes": self.max_bytes,
+        }
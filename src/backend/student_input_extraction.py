@@ -1,18 +1,36 @@
 import logging
+from typing import Dict
+
 from dotenv import load_dotenv
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
 from src.backend.extraction_schema import StudentPreferences
-from functools import lru_cache
+from backend.response_cache import cached_response, response_key
 
 load_dotenv()
 
+EXTRACTION_MODEL = "gpt-4o"
+# Part of the response cache key, bump it whenever the prompt or StudentPreferences changes
+EXTRACTION_PROMPT_VERSION = 1
+
 
 EXAMPLE_INPUT = "Im a student in my 6th semester currently studying Computer Science at TUM. I already did the following electory courses: ERDB, IT Securiy and Business Analytics and Machine Learning. I really liked Machine Learning and I want to specialize in this subject for my masters. Im also interested in System Design especially in Microservice and Cloud Architecture. I don't like low level programming such as C. I like high level languages such as Java and Python"
 
 
-@lru_cache
-def extract_student_preferences(student_input=EXAMPLE_INPUT) -> StudentPreferences:
+def extract_student_preferences(student_input=EXAMPLE_INPUT) -> Dict:
+    """
+    Returns the preferences in `student_input` as a StudentPreferences.to_json() dict,
+    cached on disk per normalized student input.
+    """
+    return cached_response(
+        response_key(
+            "extraction", EXTRACTION_MODEL, EXTRACTION_PROMPT_VERSION, student_input
+        ),
+        lambda: request_student_preferences(student_input),
+    )
+
+
+def request_student_preferences(student_input) -> Dict:
     logging.info("Extracting Student Input....")
     prompt = ChatPromptTemplate.from_messages(
         [
@@ -27,7 +45,7 @@ def extract_student_preferences(student_input=EXAMPLE_INPUT) -> StudentPreferenc
         ]
     )
 
-    llm = ChatOpenAI(model="gpt-4o", temperature=0)
+    llm = ChatOpenAI(model=EXTRACTION_MODEL, temperature=0)
 
     runnable = prompt | llm.with_structured_output(schema=StudentPreferences)
 
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.db_models import Session, Topic
+from backend.embeddings import embeddings_to_matrix
+
+load_dotenv()
+
+# The persisted topic index lives next to the database:
+#   <base>.json                      points to the current version and stores its checksum
+#   <base>-<type>-<checksum>.faiss   the faiss index (memory-mapped on load)
+# Vectors are stored under their topic_id (IndexIDMap2), so search results are topic ids and
+# single topics can be added, replaced or removed without rebuilding the index.
+# Versioned files are never modified, so workers that still map an old version keep working.
+TOPIC_INDEX_PATH = os.getenv("TOPIC_INDEX_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DB_PATH", "modules.db"))),
+    "topic_index",
+)
+
+# flat: exact L2 search, ivf: IVF-Flat, hnsw: HNSW graph, ip: exact inner product over
+# normalized vectors
+TOPIC_INDEX_TYPES = ("flat", "ivf", "hnsw", "ip")
+TOPIC_INDEX_TYPE = os.getenv("TOPIC_INDEX_TYPE", "flat")
+IVF_NPROBE = int(os.getenv("TOPIC_INDEX_IVF_NPROBE", 16))
+HNSW_M = int(os.getenv("TOPIC_INDEX_HNSW_M", 32))
+HNSW_EF_SEARCH = int(os.getenv("TOPIC_INDEX_HNSW_EF_SEARCH", 128))
+
+
+def make_index(embeddings, index_type=TOPIC_INDEX_TYPE, ids=None):
+    """
+    Builds a faiss index of type `index_type` over the float32 matrix `embeddings`, keyed by
+    `ids` (defaults to the row numbers).
+    """
+    if index_type not in TOPIC_INDEX_TYPES:
+        raise ValueError(
+            f"Unknown index type {index_type!r}, expected one of {TOPIC_INDEX_TYPES}"
+        )
+    size, dimension = embeddings.shape
+    if index_type == "flat":
+        base_index = faiss.IndexFlatL2(dimension)
+    elif index_type == "ip":
+        base_index = faiss.IndexFlatIP(dimension)
+    elif index_type == "ivf":
+        # Rule of thumb: ~4 * sqrt(n) lists, but enough training points per list
+        nlist = max(1, min(int(4 * np.sqrt(size)), size // 39))
+        base_index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
+        base_index.train(embeddings)
+        base_index.nprobe = min(IVF_NPROBE, nlist)
+        # Needed to reconstruct vectors. IVF lists cannot remove vectors behind the id map,
+        # removals rebuild the index (see rebuild_without)
+        base_index.make_direct_map()
+    else:
+        base_index = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        base_index.hnsw.efConstruction = 2 * HNSW_M
+        base_index.hnsw.efSearch = HNSW_EF_SEARCH
+    index = faiss.IndexIDMap2(base_index)
+    add_to_index(index, np.arange(size) if ids is None else ids, embeddings)
+    return index
+
+
+def add_to_index(index, ids, embeddings):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, index.d)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        embeddings = embeddings.copy()
+        faiss.normalize_L2(embeddings)
+    index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+
+
+def remove_from_index(index, ids):
+    """Removes the vectors stored under `ids`. Returns the number of removed vectors."""
+    try:
+        return index.remove_ids(np.asarray(ids, dtype=np.int64))
+    except RuntimeError as error:
+        raise ValueError(
+            "This index type does not support removing vectors, rebuild the index instead"
+        ) from error
+
+
+def rebuild_without(index, ids, index_type):
+    """
+    A new index of `index_type` with every vector of `index` except those stored under
+    `ids`, for index types that cannot remove vectors (ivf, hnsw).
+    """
+    stored_ids, embeddings = index_vectors(index)
+    keep = ~np.isin(stored_ids, np.asarray(ids, dtype=np.int64))
+    return make_index(embeddings[keep], index_type=index_type, ids=stored_ids[keep])
+
+
+def index_ids(index):
+    """All ids stored in an index built by `make_index`, in storage order."""
+    return faiss.vector_to_array(index.id_map)
+
+
+def index_vectors(index):
+    """Returns (ids, embeddings) of all vectors stored in an index built by `make_index`."""
+    return index_ids(index), index.index.reconstruct_n(0, index.ntotal)
+
+
+def search_index(index, queries, k):
+    """
+    Runs a k-nearest-neighbour search and returns (distances, ids) as squared L2 distances
+    regardless of the index metric, so thresholds mean the same for every index type.
+    Missing results have the id -1.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, index.d)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        queries = queries.copy()
+        faiss.normalize_L2(queries)
+        similarities, ids = index.search(queries, k)
+        # |a - b|^2 = 2 - 2 * <a, b> for unit vectors
+        return 2 - 2 * similarities, ids
+    return index.search(queries, k)
+
+
+def range_search_index(index, queries, radius):
+    """
+    Returns all ids within squared L2 distance `radius` of each query as (lims, distances,
+    ids): the results of query i are distances[lims[i]:lims[i + 1]] (unsorted).
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, index.d)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        queries = queries.copy()
+        faiss.normalize_L2(queries)
+        lims, similarities, ids = index.range_search(queries, 1 - radius / 2)
+        return lims, 2 - 2 * similarities, ids
+    return index.range_search(queries, radius)
+
+
+def topics_checksum(session=None):
+    """sha256 over every (topic_id, topic, embedding) row of the topics table."""
+    checksum = hashlib.sha256()
+    for topic_id, topic, embedding in _iter_topic_rows(session):
+        _update_checksum(checksum, topic_id, topic, embedding)
+    return checksum.hexdigest()
+
+
+def _iter_topic_rows(session=None):
+    own_session = session is None
+    session = session or Session()
+    try:
+        yield from session.query(Topic.topic_id, Topic.topic, Topic.embedding).order_by(
+            Topic.topic_id
+        ).yield_per(2000)
+    finally:
+        if own_session:
+            session.close()
+
+
+def _update_checksum(checksum, topic_id, topic, embedding):
+    if isinstance(embedding, str):
+        embedding = embedding.encode()
+    checksum.update(f"{topic_id}\x00{topic}\x00".encode())
+    checksum.update(embedding or b"")
+    checksum.update(b"\x00")
+
+
+def load_topic_embeddings(session=None, dimension=1536):
+    """Returns (topic_ids, embeddings, checksum) for all topics that have an embedding."""
+    checksum = hashlib.sha256()
+    topic_ids = []
+    embeddings = []
+    for topic_id, topic, embedding in _iter_topic_rows(session):
+        _update_checksum(checksum, topic_id, topic, embedding)
+        if embedding is None:
+            continue
+        topic_ids.append(topic_id)
+        embeddings.append(embedding)
+    return (
+        np.asarray(topic_ids, dtype=np.int64),
+        embeddings_to_matrix(embeddings, dimension=dimension),
+        checksum.hexdigest(),
+    )
+
+
+def build_topic_index(session=None, index_type=TOPIC_INDEX_TYPE):
+    """
+    Builds an index of type `index_type` over all topic embeddings, keyed by topic_id.
+    Returns (index, checksum).
+    """
+    topic_ids, embeddings, checksum = load_topic_embeddings(session)
+    return make_index(embeddings, index_type=index_type, ids=topic_ids), checksum
+
+
+def write_topic_index(
+    index, checksum, path=TOPIC_INDEX_PATH, index_type=TOPIC_INDEX_TYPE
+):
+    """Writes a new index version and atomically points `path`.json at it."""
+    version_path = f"{path}-{index_type}-{checksum[:16]}"
+    # Every writer gets its own temporary file, workers may rebuild at the same time
+    temp_path = _temp_path(version_path)
+    try:
+        faiss.write_index(index, temp_path)
+        os.replace(temp_path, f"{version_path}.faiss")
+    finally:
+        _remove_if_exists(temp_path)
+
+    temp_path = _temp_path(path)
+    try:
+        with open(temp_path, "w") as file:
+            json.dump(
+                {
+                    "checksum": checksum,
+                    "index_type": index_type,
+                    "index": os.path.basename(f"{version_path}.faiss"),
+                    "size": int(index.ntotal),
+                    "dimension": int(index.d),
+                },
+                file,
+            )
+        os.replace(temp_path, f"{path}.json")
+    finally:
+        _remove_if_exists(temp_path)
+    _remove_old_versions(path, index_type, keep=version_path)
+
+
+def _temp_path(path):
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_old_versions(path, index_type, keep):
+    """Removes the other versions of `index_type`, other index types are left alone."""
+    directory, prefix = os.path.split(path)
+    for filename in os.listdir(directory or "."):
+        file_path = os.path.join(directory, filename)
+        if (
+            filename.startswith(f"{prefix}-{index_type}-")
+            and not file_path.startswith(keep)
+            and filename.endswith(".faiss")
+        ):
+            # Processes that still map the file keep their copy until they exit
+            os.remove(file_path)
+
+
+def read_topic_index_meta(path=TOPIC_INDEX_PATH):
+    try:
+        with open(f"{path}.json") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def load_topic_index(path=TOPIC_INDEX_PATH, checksum=None, index_type=TOPIC_INDEX_TYPE):
+    """
+    Opens the persisted index memory-mapped (read-only). Returns (index, checksum) or None if
+    there is no index of `index_type` on disk or it was built from a different topics table
+    than `checksum`.
+    """
+    meta = read_topic_index_meta(path)
+    if meta is None:
+        return None
+    if checksum is not None and meta["checksum"] != checksum:
+        logging.info("Persisted topic index is stale")
+        return None
+    if meta.get("index_type", "flat") != index_type:
+        logging.info("Persisted topic index is of type %s", meta.get("index_type"))
+        return None
+
+    directory = os.path.dirname(path)
+    index_path = os.path.join(directory, meta["index"])
+    mmap_flags = (
+        faiss.IO_FLAG_MMAP
+        | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        | faiss.IO_FLAG_READ_ONLY
+    )
+    try:
+        try:
+            index = faiss.read_index(index_path, mmap_flags)
+        except RuntimeError:
+            # Older faiss builds cannot map flat indexes and HNSW graphs are never mapped
+            logging.warning("Memory-mapping %s failed, reading it instead", index_path)
+            index = faiss.read_index(index_path)
+    except (FileNotFoundError, RuntimeError):
+        return None
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Array:
+        # Versions written with a hashtable direct map cannot reconstruct vectors
+        ivf.set_direct_map_type(faiss.DirectMap.Array)
+    return index, meta["checksum"]
+
+
+def load_or_build_topic_index(
+    path=TOPIC_INDEX_PATH, session=None, index_type=TOPIC_INDEX_TYPE
+):
+    """
+    Loads the persisted index, rebuilding and persisting it if the topics table changed.
+    Returns (index, checksum).
+    """
+    checksum = topics_checksum(session)
+    loaded = load_topic_index(path, checksum=checksum, index_type=index_type)
+    if loaded:
+        return loaded
+    logging.info("Building %s topic index ...", index_type)
+    index, checksum = build_topic_index(session, index_type=index_type)
+    try:
+        write_topic_index(index, checksum, path=path, index_type=index_type)
+    except OSError:
+        logging.exception("Could not persist topic index to %s", path)
+    return index, checksum
@@ -1,18 +1,42 @@
 import csv
-from functools import lru_cache
+import logging
+import os
+import sys
+import threading
+import time
+from typing import NamedTuple
 
 import faiss  # make faiss available
-import json
 import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
 from sqlalchemy import func
 from backend.db_models import Session, Topic
+from backend.embeddings import cached_embed_texts, embeddings_to_matrix, normalize_text
+from backend.topic_index import (
+    TOPIC_INDEX_PATH,
+    TOPIC_INDEX_TYPE,
+    add_to_index,
+    index_ids,
+    index_vectors,
+    load_or_build_topic_index,
+    load_topic_index,
+    make_index,
+    range_search_index,
+    read_topic_index_meta,
+    rebuild_without,
+    remove_from_index,
+    search_index,
+    write_topic_index,
+)
+from backend.topic_neighbors import load_topic_neighbors
 from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
 
 load_dotenv()
 
+# How often (seconds) a server checks for a newer persisted topic index
+TOPIC_INDEX_RELOAD_INTERVAL = int(os.getenv("TOPIC_INDEX_RELOAD_INTERVAL", 30))
+
 
 def get_all_topics(max_size=None):
     with Session() as session:
@@ -23,65 +47,378 @@ def get_all_topics(max_size=None):
     return topics
 
 
-class VectorStore:
-    def __init__(self, topics=None, max_size=None):
-        if not topics:
-            topics = get_all_topics(max_size=max_size)
-        self.topics: [Topic] = topics
-        self.index = self.build_index([topic.embedding for topic in topics])
+class TopicMatch(NamedTuple):
+    topic_id: int
+    topic: str
+    distance: float
 
-    @staticmethod
-    def build_index(embeddings, dimension=1536):
-        embeddings = [
-            np.array(json.loads(embedding_str)) for embedding_str in embeddings
+
+class TopicCatalog:
+    """
+    Compact topic_id -> name lookup: a sorted int64 id array and a list of interned names.
+    Neither ORM objects nor embeddings are kept, those only matter while building the index.
+    """
+
+    def __init__(self, topic_ids, names):
+        topic_ids = np.asarray(topic_ids, dtype=np.int64)
+        order = np.argsort(topic_ids, kind="stable")
+        self.topic_ids = topic_ids[order]
+        self.names = [sys.intern(names[position]) for position in order.tolist()]
+        self._ids_by_name = None
+
+    @classmethod
+    def load(cls):
+        """The topics that have an embedding, i.e. the ones in the topic index."""
+        with Session() as session:
+            rows = (
+                session.query(Topic.topic_id, Topic.topic)
+                .filter(Topic.embedding.isnot(None))
+                .all()
+            )
+        return cls([row[0] for row in rows], [row[1] for row in rows])
+
+    @classmethod
+    def from_topics(cls, topics):
+        """Builds the catalog from objects with topic_id and topic attributes."""
+        return cls(
+            [topic.topic_id for topic in topics], [topic.topic for topic in topics]
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, topic_id):
+        position = np.searchsorted(self.topic_ids, topic_id)
+        return position < len(self.topic_ids) and self.topic_ids[position] == topic_id
+
+    def topic_id_of(self, name):
+        """Returns the id of the topic called `name` (ignoring case and whitespace) or None."""
+        if self._ids_by_name is None:
+            ids_by_name = {}
+            for topic_id, topic_name in zip(self.topic_ids.tolist(), self.names):
+                ids_by_name.setdefault(normalize_text(topic_name), topic_id)
+            self._ids_by_name = ids_by_name
+        return self._ids_by_name.get(normalize_text(name))
+
+    def names_of(self, topic_ids):
+        positions = np.searchsorted(self.topic_ids, topic_ids).tolist()
+        return [self.names[position] for position in positions]
+
+    def matches(self, topic_ids, distances):
+        return [
+            TopicMatch(topic_id, name, distance)
+            for topic_id, name, distance in zip(
+                topic_ids.tolist(), self.names_of(topic_ids), distances.tolist()
+            )
         ]
-        # Convert the list of arrays into a single NumPy array
-        embeddings_np = np.array(embeddings)
-
-        _index = faiss.IndexFlatL2(dimension)  # build the index
-        _index.add(embeddings_np)
-        return _index
-
-    @lru_cache
-    def vector_similarity_search(self, topic_str, k, threshold=None):
-        client = OpenAI()
-        topic_embedding = (
-            client.embeddings.create(input=topic_str, model="text-embedding-ada-002")
-            .data[0]
-            .embedding
+
+    def updated(self, remove_topic_ids=(), add_topic_ids=(), add_names=()):
+        """Returns a new catalog without `remove_topic_ids` and with the added topics."""
+        keep = ~np.isin(self.topic_ids, np.asarray(remove_topic_ids, dtype=np.int64))
+        return TopicCatalog(
+            np.concatenate(
+                [self.topic_ids[keep], np.asarray(add_topic_ids, dtype=np.int64)]
+            ),
+            [name for name, kept in zip(self.names, keep.tolist()) if kept]
+            + list(add_names),
         )
-        embedding_np = np.array(topic_embedding).reshape(
-            1, -1
-        )  # Reshape to a 2D array (1, dimension)
-        distances, indices = self.index.search(embedding_np, k)
-
-        if threshold:
-            # Filter out results based on the threshold
-            mask = distances[0] <= threshold
-            indices = indices[0][mask]
-            distances = distances[0][mask]
+
+
+class VectorStore:
+    def __init__(
+        self,
+        topics=None,
+        max_size=None,
+        index_path=TOPIC_INDEX_PATH,
+        index_type=TOPIC_INDEX_TYPE,
+    ):
+        self.index_path = index_path
+        self.index_type = index_type
+        self.checksum = None
+        self.neighbors = None
+        self._reload_checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        if topics or max_size:
+            # Ad-hoc subsets of the topics table are indexed in memory
+            if not topics:
+                topics = get_all_topics(max_size=max_size)
+            self.catalog = TopicCatalog.from_topics(topics)
+            self.index = self.build_index(
+                [topic.embedding for topic in topics],
+                index_type=index_type,
+                ids=[topic.topic_id for topic in topics],
+            )
         else:
-            indices = indices[0]
-            distances = distances[0]
+            # The full table is served from the persisted, memory-mapped index
+            self.index, self.checksum = load_or_build_topic_index(
+                index_path, index_type=index_type
+            )
+            self.catalog = TopicCatalog.load()
+            self.neighbors = load_topic_neighbors(checksum=self.checksum)
+
+    @classmethod
+    def from_index(cls, index, catalog=None, index_type=None):
+        """
+        Wraps an already built index of `index_type`. Without a catalog the topics are named
+        by their ids.
+        """
+        vectorstore = cls.__new__(cls)
+        vectorstore.index = index
+        if catalog is None:
+            topic_ids = index_ids(index)
+            catalog = TopicCatalog(topic_ids, [str(topic_id) for topic_id in topic_ids])
+        vectorstore.catalog = catalog
+        vectorstore.index_path = None
+        vectorstore.index_type = index_type
+        vectorstore.checksum = None
+        vectorstore.neighbors = None
+        vectorstore._lock = threading.Lock()
+        return vectorstore
 
-        return [self.topics[index] for index in indices]
+    @staticmethod
+    def build_index(embeddings, dimension=1536, index_type=TOPIC_INDEX_TYPE, ids=None):
+        embeddings_np = embeddings_to_matrix(embeddings, dimension=dimension)
+        return make_index(embeddings_np, index_type=index_type, ids=ids)
+
+    def _update(self, remove_topic_ids=(), add_topics=(), add_embeddings=None):
+        # Copy-on-write: the live index may be memory-mapped read-only and is searched
+        # concurrently, so changes go to a private copy that is swapped in afterwards
+        index, catalog = self._snapshot()
+        index = faiss.deserialize_index(faiss.serialize_index(index))
+        if remove_topic_ids:
+            try:
+                remove_from_index(index, remove_topic_ids)
+            except ValueError:
+                logging.info(
+                    "The %s topic index cannot remove vectors, rebuilding it",
+                    self.index_type,
+                )
+                index = rebuild_without(index, remove_topic_ids, self.index_type)
+            catalog = catalog.updated(remove_topic_ids=remove_topic_ids)
+        if add_topics:
+            topic_ids = [topic.topic_id for topic in add_topics]
+            existing = [topic_id for topic_id in topic_ids if topic_id in catalog]
+            if existing:
+                raise ValueError(
+                    f"Topics {existing} are already indexed, replace them instead"
+                )
+            add_to_index(index, topic_ids, add_embeddings)
+            catalog = catalog.updated(
+                add_topic_ids=topic_ids, add_names=[topic.topic for topic in add_topics]
+            )
+        with self._lock:
+            # The precomputed neighbours no longer match the changed index
+            self.index, self.catalog, self.neighbors = index, catalog, None
 
-    def map_topic(self, topic, k, threshold=None):
-        return self.vector_similarity_search(topic_str=topic, k=k, threshold=threshold)
+    def add_topics(self, topics, embeddings):
+        """Adds `topics` (objects with topic_id and topic) with their embeddings."""
+        self._update(add_topics=topics, add_embeddings=embeddings)
 
-    def map_topics(self, topics, k, threshold=None):
-        topic_mappings = {}
-        for topic in topics:
-            topic_mappings[topic] = self.map_topic(topic, k, threshold=threshold)
-        return topic_mappings
+    def remove_topics(self, topic_ids):
+        self._update(remove_topic_ids=topic_ids)
+
+    def replace_topics(self, topics, embeddings):
+        """Replaces the name and embedding of indexed topics, unknown topics are added."""
+        self._update(
+            remove_topic_ids=[topic.topic_id for topic in topics],
+            add_topics=topics,
+            add_embeddings=embeddings,
+        )
+
+    def save(self, checksum):
+        """
+        Persists the current index as the version for the topics table with `checksum`.
+        Servers that load the index pick the new version up without rebuilding it.
+        """
+        write_topic_index(
+            self.index, checksum, path=self.index_path, index_type=self.index_type
+        )
+        self.checksum = checksum
+
+    def reload_if_changed(self, interval=TOPIC_INDEX_RELOAD_INTERVAL):
+        """
+        Maps a newer persisted index version (e.g. written by 06_update_topic_index.py) at
+        most every `interval` seconds. Returns True if the index was reloaded.
+        """
+        if self.checksum is None or not self.index_path:
+            return False
+        now = time.monotonic()
+        if now - self._reload_checked_at < interval:
+            return False
+        self._reload_checked_at = now
+        meta = read_topic_index_meta(self.index_path)
+        if not meta or meta["checksum"] == self.checksum:
+            return False
+        loaded = load_topic_index(
+            self.index_path, checksum=meta["checksum"], index_type=self.index_type
+        )
+        if not loaded:
+            return False
+        catalog = TopicCatalog.load()
+        neighbors = load_topic_neighbors(checksum=meta["checksum"])
+        logging.info("Reloading topic index version %s", meta["checksum"][:16])
+        with self._lock:
+            (self.index, self.checksum), self.catalog = loaded, catalog
+            self.neighbors = neighbors
+        return True
+
+    def _snapshot(self):
+        # Index and catalog are swapped together on reload
+        with self._lock:
+            return self.index, self.catalog
+
+    def _lookup_known_topics(self, topics, ks, thresholds, range_search):
+        """
+        Answers queries for topics that are already in the topic index from the precomputed
+        neighbours, without an embeddings request or an index search. Returns the results
+        ({query position: matches}) and the vectors of known topics the table cannot answer
+        ({query position: vector}), both taken from the current index.
+        """
+        with self._lock:
+            index, catalog, neighbors = self.index, self.catalog, self.neighbors
+        results, vectors = {}, {}
+        for position, (topic, k, threshold) in enumerate(zip(topics, ks, thresholds)):
+            topic_id = catalog.topic_id_of(topic)
+            if topic_id is None:
+                continue
+            found = None
+            if neighbors is not None and (k is not None or range_search):
+                found = neighbors.lookup(topic_id, k, threshold)
+            if found is not None:
+                results[position] = catalog.matches(*found)
+                continue
+            try:
+                vectors[position] = index.reconstruct(topic_id)
+            except RuntimeError:
+                # Not in this index version (e.g. a topic added since), embed it instead
+                logging.warning("Topic %s is not in the topic index", topic_id)
+        return results, vectors
+
+    def vector_similarity_search(
+        self, topic_str, k, threshold=None, range_search=False
+    ):
+        return self.map_topics_batched(
+            [(topic_str, k, threshold)], range_search=range_search
+        )[0]
+
+    @staticmethod
+    def embed_topics(topics):
+        """
+        Returns the embeddings of `topics` as a (len(topics), d) matrix. Embeddings come from
+        the persistent embedding cache, all topics that are not cached yet are embedded with a
+        single request.
+        """
+        return cached_embed_texts(topics)
+
+    def search_embeddings(self, embeddings, ks, thresholds):
+        """
+        Searches all query embeddings with one index search. Row i keeps at most ks[i] results
+        with a distance of at most thresholds[i].
+        """
+        index, catalog = self._snapshot()
+        distances, topic_ids = search_index(index, embeddings, max(ks))
+        results = []
+        for row_distances, row_topic_ids, k, threshold in zip(
+            distances, topic_ids, ks, thresholds
+        ):
+            row_distances, row_topic_ids = row_distances[:k], row_topic_ids[:k]
+            # Approximate indexes pad missing results with -1
+            mask = row_topic_ids >= 0
+            if threshold:
+                # Filter out results based on the threshold
+                mask &= row_distances <= threshold
+            results.append(catalog.matches(row_topic_ids[mask], row_distances[mask]))
+        return results
+
+    def range_search_embeddings(self, embeddings, max_results, thresholds):
+        """
+        Returns every topic within thresholds[i] of query i, closest first and capped at
+        max_results[i] (None for no cap). Unlike a top-k search nothing inside the radius is
+        dropped and nothing outside of it is computed and sorted.
+        """
+        index, catalog = self._snapshot()
+        try:
+            lims, distances, topic_ids = range_search_index(
+                index, embeddings, max(thresholds)
+            )
+        except RuntimeError:
+            # Index types without range search support fall back to an exhaustive top-k
+            caps = [cap or index.ntotal for cap in max_results]
+            return self.search_embeddings(embeddings, caps, thresholds)
+        results = []
+        for i, (cap, threshold) in enumerate(zip(max_results, thresholds)):
+            row_distances = distances[lims[i] : lims[i + 1]]
+            row_topic_ids = topic_ids[lims[i] : lims[i + 1]]
+            mask = row_distances <= threshold
+            row_distances, row_topic_ids = row_distances[mask], row_topic_ids[mask]
+            order = np.argsort(row_distances, kind="stable")[:cap]
+            results.append(catalog.matches(row_topic_ids[order], row_distances[order]))
+        return results
+
+    def search_embedding(self, embedding, k, threshold=None):
+        return self.search_embeddings(embedding, [k], [threshold])[0]
+
+    def map_topic(self, topic, k, threshold=None, range_search=False):
+        return self.vector_similarity_search(
+            topic_str=topic, k=k, threshold=threshold, range_search=range_search
+        )
+
+    def map_topics(self, topics, k, threshold=None, range_search=False):
+        topic_mappings = self.map_topics_batched(
+            [(topic, k, threshold) for topic in topics], range_search=range_search
+        )
+        return dict(zip(topics, topic_mappings))
+
+    def map_topics_batched(self, queries, range_search=False):
+        """
+        Maps a list of (topic, k, threshold) queries with one embeddings request and one index
+        search. Returns the mapped topics of every query in the same order.
+        With `range_search` every topic within the threshold is returned and k only caps the
+        number of results (None for no cap).
+        Topics that are already in the topics table are answered from the precomputed
+        neighbours where possible and are never embedded again.
+        """
+        if not queries:
+            return []
+        self.reload_if_changed()
+        topics, ks, thresholds = zip(*queries)
+        if range_search and any(threshold is None for threshold in thresholds):
+            raise ValueError("Range search requires a threshold")
+        results, vectors = self._lookup_known_topics(
+            topics, ks, thresholds, range_search
+        )
+        pending = [
+            position for position in range(len(queries)) if position not in results
+        ]
+        unknown = [position for position in pending if position not in vectors]
+        if unknown:
+            embedded = self.embed_topics([topics[position] for position in unknown])
+            vectors.update(zip(unknown, embedded))
+        if pending:
+            embeddings = np.stack([vectors[position] for position in pending])
+            pending_ks = [ks[position] for position in pending]
+            pending_thresholds = [thresholds[position] for position in pending]
+            if range_search:
+                mapped = self.range_search_embeddings(
+                    embeddings, pending_ks, pending_thresholds
+                )
+            else:
+                mapped = self.search_embeddings(
+                    embeddings, pending_ks, pending_thresholds
+                )
+            results.update(zip(pending, mapped))
+        return [results[position] for position in range(len(queries))]
 
     def save_2d_projection(
-        self, filename="projection.png", transparent=True, x_offset=0.003, y_offset=0.003
+        self,
+        filename="projection.png",
+        transparent=True,
+        x_offset=0.003,
+        y_offset=0.003,
     ):
         # Convert embeddings to numpy array if not already done
-        embeddings = np.array(
-            [np.array(json.loads(topic.embedding)) for topic in self.topics]
-        )
+        topic_ids, embeddings = index_vectors(self.index)
+        names = self.catalog.names_of(topic_ids)
 
         # Use PCA to reduce dimensions to 2
         pca = PCA(n_components=2)
@@ -92,11 +429,11 @@ class VectorStore:
         plt.scatter(embeddings_2d[:, 0], embeddings_2d[:, 1], s=50, alpha=0.7)
 
         # Add topic names with a slight offset to avoid overlap
-        for i, topic in enumerate(self.topics):
+        for i, name in enumerate(names):
             plt.text(
                 embeddings_2d[i, 0],
                 embeddings_2d[i, 1],
-                topic.topic,
+                name,
                 fontsize=9,
             )
 
@@ -114,9 +451,8 @@ class VectorStore:
 
     def save_2d_projection_csv(self, filename="projection.csv"):
         # Convert embeddings to numpy array if not already done
-        embeddings = np.array(
-            [np.array(json.loads(topic.embedding)) for topic in self.topics]
-        )
+        topic_ids, embeddings = index_vectors(self.index)
+        names = self.catalog.names_of(topic_ids)
 
         # Use PCA to reduce dimensions to 2
         pca = PCA(n_components=2)
@@ -126,5 +462,5 @@ class VectorStore:
         with open(filename, mode="w", newline="") as file:
             writer = csv.writer(file)
             writer.writerow(["Topic", "x", "y"])  # Header row
-            for i, topic in enumerate(self.topics):
-                writer.writerow([topic.topic, embeddings_2d[i, 0], embeddings_2d[i, 1]])
+            for i, name in enumerate(names):
+                writer.writerow([name, embeddings_2d[i, 0], embeddings_2d[i, 1]])
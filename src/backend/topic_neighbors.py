@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.topic_index import index_ids, search_index
+
+load_dotenv()
+
+# Precomputed nearest neighbours of every topic, stored next to the database:
+#   <base>.json   checksum of the topics table the neighbours were computed from
+#   <base>.npy    one record per topic, sorted by topic_id, memory-mapped on load
+TOPIC_NEIGHBORS_PATH = os.getenv("TOPIC_NEIGHBORS_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DB_PATH", "modules.db"))),
+    "topic_neighbors",
+)
+# Covers the default maxMappings of /map-topic
+TOPIC_NEIGHBORS = int(os.getenv("TOPIC_NEIGHBORS", 100))
+
+
+def neighbors_dtype(n_neighbors):
+    return np.dtype(
+        [
+            ("topic_id", "<i8"),
+            ("neighbor_ids", "<i8", (n_neighbors,)),
+            ("distances", "<f4", (n_neighbors,)),
+        ]
+    )
+
+
+def compute_topic_neighbors(index, n_neighbors=TOPIC_NEIGHBORS, batch_size=1024):
+    """
+    Searches the n_neighbors nearest topics (including the topic itself) of every topic in
+    `index`. Returns a record array sorted by topic_id, missing neighbours have the id -1.
+    """
+    topic_ids = np.sort(index_ids(index))
+    n_neighbors = min(n_neighbors, len(topic_ids))
+    table = np.zeros(len(topic_ids), dtype=neighbors_dtype(n_neighbors))
+    table["topic_id"] = topic_ids
+    for start in range(0, len(topic_ids), batch_size):
+        batch_ids = topic_ids[start : start + batch_size]
+        embeddings = np.stack(
+            [index.reconstruct(int(topic_id)) for topic_id in batch_ids]
+        )
+        distances, neighbor_ids = search_index(index, embeddings, n_neighbors)
+        table["neighbor_ids"][start : start + len(batch_ids)] = neighbor_ids
+        table["distances"][start : start + len(batch_ids)] = distances
+    return table
+
+
+def write_topic_neighbors(table, checksum, path=TOPIC_NEIGHBORS_PATH):
+    with open(f"{path}.npy.tmp", "wb") as file:
+        np.save(file, table)
+    os.replace(f"{path}.npy.tmp", f"{path}.npy")
+    with open(f"{path}.json.tmp", "w") as file:
+        json.dump({"checksum": checksum, "size": len(table)}, file)
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+
+
+def load_topic_neighbors(path=TOPIC_NEIGHBORS_PATH, checksum=None):
+    """
+    Maps the precomputed neighbours. Returns None if they are missing or were computed from a
+    different topics table than `checksum`.
+    """
+    try:
+        with open(f"{path}.json") as file:
+            meta = json.load(file)
+        if checksum is not None and meta["checksum"] != checksum:
+            logging.info("Precomputed topic neighbours are stale, not using them")
+            return None
+        return TopicNeighbors(np.load(f"{path}.npy", mmap_mode="r"))
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+
+
+class TopicNeighbors:
+    def __init__(self, table):
+        self.table = table
+        self.topic_ids = table["topic_id"]
+        self.n_neighbors = table.dtype["neighbor_ids"].shape[0]
+
+    def lookup(self, topic_id, k, threshold=None):
+        """
+        Returns (neighbor_ids, distances) of the at most k closest topics within `threshold`
+        (k=None for no cap), or None if the stored neighbours cannot answer the query exactly.
+        """
+        position = np.searchsorted(self.topic_ids, topic_id)
+        if position == len(self.topic_ids) or self.topic_ids[position] != topic_id:
+            return None
+        record = self.table[position]
+        neighbor_ids, distances = record["neighbor_ids"], record["distances"]
+        stored = neighbor_ids >= 0
+        neighbor_ids, distances = neighbor_ids[stored], distances[stored]
+        # The stored neighbours are a prefix of all topics ordered by distance. It covers
+        # every topic up to the last stored distance, unless it holds all topics anyway.
+        if self.n_neighbors >= len(self.topic_ids):
+            covered = np.inf
+        else:
+            covered = float(distances[-1]) if len(distances) else 0.0
+
+        mask = np.ones(len(neighbor_ids), dtype=bool)
+        if threshold:
+            mask &= distances <= threshold
+        neighbor_ids, distances = neighbor_ids[mask][:k], distances[mask][:k]
+        if (
+            covered == np.inf
+            or (k is not None and len(neighbor_ids) == k)
+            or (threshold and threshold < covered)
+        ):
+            return neighbor_ids, distances
+        return None
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+
+class LazyResource:
+    """
+    A heavy singleton (e.g. the VectorStore) that is built on first use or in a background
+    thread. Attribute access is forwarded to the built object, so it can be used in place of
+    it; callers block until it is ready. `report` turns the built object into details for
+    the /ready endpoint, e.g. how many cache keys a warm-up stage filled.
+    """
+
+    PENDING = "pending"
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, name, factory, report=None):
+        self.name = name
+        self.factory = factory
+        self.report = report
+        self.state = self.PENDING
+        self.error = None
+        self.seconds = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.state != self.READY:
+            self._build()
+        return self._value
+
+    def _build(self):
+        with self._lock:
+            # Another thread may have finished building while we waited for the lock
+            if self.state == self.READY:
+                return
+            self.state = self.WARMING
+            start = time.perf_counter()
+            try:
+                self._value = self.factory()
+            except Exception as error:
+                self.state = self.FAILED
+                self.error = repr(error)
+                logging.exception("Warming up %s failed", self.name)
+                raise
+            self.seconds = round(time.perf_counter() - start, 3)
+            self.state = self.READY
+            self.error = None
+            logging.info("%s ready after %ss", self.name, self.seconds)
+
+    def start(self):
+        """Builds the resource in a daemon thread unless it is already built or building."""
+        if self.state not in (self.PENDING, self.FAILED) or self._lock.locked():
+            return
+        thread = threading.Thread(
+            target=self._build_quietly, name=f"warmup-{self.name}", daemon=True
+        )
+        thread.start()
+
+    def _build_quietly(self):
+        try:
+            self.get()
+        except Exception:
+            # Already logged, the state is reported by /ready
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def start_warmup(resources):
+    for resource in resources:
+        resource.start()
+
+
+def readiness(resources):
+    """Returns (ready, {name: {"state": ..., ...}}) for the /ready endpoint."""
+    states = {
+        resource.name: {
+            "state": resource.state,
+            "seconds": resource.seconds,
+            "error": resource.error,
+        }
+        for resource in resources
+    }
+    for resource in resources:
+        if resource.report and resource.state == LazyResource.READY:
+            states[resource.name]["report"] = resource.report(resource.get())
+    return all(resource.state == LazyResource.READY for resource in resources), states
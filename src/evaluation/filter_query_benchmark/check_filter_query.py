@@ -0,0 +1,383 @@
+# Regression check and benchmark for the filter query of backend/module_filter.py.
+# The query, which looks up topics and prerequisites per candidate module, must return the
+# same modules as the former query that joined topics and prerequisites before aggregating
+# (kept below as reference for the rows and columns), ordered by the true counts: most
+# matching topics of interest, then most previous modules among the prerequisites, then
+# module_id. The former query summed over the (topics x prerequisites) rows, which inflated
+# both counts, so its order is not the reference. The intended order is computed
+# independently from the mapping tables. Random filter combinations are compared on the
+# configured database (also for the module_serving query and the module catalog), then
+# both queries are timed on it and on a copy where every module has many topics and
+# prerequisites. Exits with status 1 if any combination differs.
+import itertools
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import func, distinct, or_, case, select, create_engine
+from sqlalchemy.orm import aliased, sessionmaker
+from sqlalchemy.sql import and_
+
+from backend.db_models import (
+    Session,
+    Module,
+    Organisation,
+    ModuleTopicMapping,
+    Topic,
+    ModulePrerequisiteMapping,
+)
+from backend.module_filter import (
+    MODULE_FIELDS,
+    department_mapper,
+    filter_catalog,
+    filtered_modules_query,
+    language_mapper,
+    module_dict,
+    school_mapper,
+    serving_modules_query,
+    study_level_mapper,
+)
+from backend.module_serving import build_module_serving, module_serving_available
+
+load_dotenv()
+
+N_COMBINATIONS = 300
+N_TIMED = 30
+# Mappings per module in the enlarged copy
+MANY_TOPICS = 40
+MANY_PREREQUISITES = 15
+
+rng = random.Random(42)
+
+
+def legacy_filtered_modules_query(
+    session,
+    schools,
+    study_level,
+    ects_min,
+    ects_max,
+    digital_score_min,
+    digital_score_max,
+    module_languages,
+    departments,
+    previous_modules,
+    topics_of_interest,
+    excluded_topics,
+    fields=MODULE_FIELDS,
+):
+    """
+    The former filter query: topics and prerequisites are joined into one row per
+    (topic, prerequisite) pair and aggregated afterwards. Kept as the reference for the
+    matching modules and their columns, its order comes from `intended_order`.
+    """
+    department = aliased(Organisation)
+    school = aliased(Organisation)
+    columns = {
+        "id": Module.module_id_uni,
+        "title": Module.name,
+        "description": Module.description,
+        "prereq": Module.prereq,
+        "digitalScore": Module.digital_score,
+        "ects": Module.ects,
+        "language": Module.lang,
+        "studyLevel": Module.level,
+        "OrgId": Module.org_id,
+        "chair": Organisation.name.label("organisation"),
+        "department": department.name.label("department"),
+        "school": school.name.label("school"),
+        "topics": func.group_concat(distinct(Topic.topic)).label("topics"),
+        "prereqModules": func.group_concat(
+            distinct(ModulePrerequisiteMapping.prereq_module_id_uni)
+        ).label("prereqModules"),
+    }
+
+    # Base query with added custom ordering fields
+    query = (
+        session.query(*[columns[field] for field in fields])
+        .select_from(Module)
+        .outerjoin(Organisation, Module.org_id == Organisation.org_id)
+        .outerjoin(department, Organisation.dep_id == department.org_id)
+        .outerjoin(school, Organisation.school_id == school.org_id)
+        .join(ModuleTopicMapping, Module.module_id == ModuleTopicMapping.module_id)
+        .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
+        .outerjoin(
+            ModulePrerequisiteMapping,
+            ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni,
+        )
+    )
+
+    filters_and = []
+    filters_or = []
+
+    if module_languages:
+        languages_mapped = set(
+            itertools.chain.from_iterable(
+                [language_mapper[lang] for lang in module_languages]
+            )
+        )
+        filters_and.append(Module.lang.in_(languages_mapped))
+
+    if study_level:
+        study_levels = study_level_mapper[study_level]
+        filters_and.append(Module.level.in_(study_levels))
+
+    if ects_min is not None:
+        filters_and.append(Module.ects >= ects_min)
+
+    if ects_max is not None:
+        filters_and.append(Module.ects <= ects_max)
+
+    if digital_score_min is not None:
+        filters_and.append(Module.digital_score >= digital_score_min)
+
+    if digital_score_max is not None:
+        filters_and.append(Module.digital_score <= digital_score_max)
+
+    if schools:
+        school_ids = [school_mapper[school] for school in schools]
+        filters_and.append(Organisation.school_id.in_(school_ids))
+
+    if departments:
+        department_ids = [department_mapper[department] for department in departments]
+        filters_and.append(department.org_id.in_(department_ids))
+
+    if previous_modules:
+        previous_module_exists = (
+            session.query(ModulePrerequisiteMapping)
+            .filter(
+                and_(
+                    ModulePrerequisiteMapping.module_id_uni == Module.module_id_uni,
+                    ModulePrerequisiteMapping.prereq_module_id_uni.in_(
+                        previous_modules
+                    ),
+                )
+            )
+            .correlate(Module)
+            .exists()
+        )
+        filters_or.append(previous_module_exists)
+    if topics_of_interest:
+        filters_and.append(
+            session.query(Topic.topic_id)
+            .filter(
+                and_(
+                    Module.module_id == ModuleTopicMapping.module_id,
+                    ModuleTopicMapping.topic_id == Topic.topic_id,
+                    Topic.topic.in_(topics_of_interest),
+                )
+            )
+            .correlate(Module)
+            .exists()
+        )
+
+    if excluded_topics:
+        excluded_modules_subquery = (
+            session.query(Module.module_id)
+            .join(ModuleTopicMapping, Module.module_id == ModuleTopicMapping.module_id)
+            .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
+            .filter(Topic.topic.in_(excluded_topics))
+            .subquery()
+        )
+
+        # Now we use select to explicitly refer to the module_id in the subquery
+        filters_and.append(
+            ~Module.module_id.in_(select(excluded_modules_subquery.c.module_id))
+        )
+
+    # Apply filters only if they exist
+    if filters_and:
+        query = query.filter(or_(and_(*filters_and), *filters_or))
+
+    # Order by the number of matching topics of interest and whether it has previous modules as prerequisites
+    query = query.order_by(
+        func.sum(
+            case((Topic.topic.in_(topics_of_interest), 1), else_=0)
+        ).desc(),  # Modules with more matching topics of interest first
+        func.sum(
+            ModulePrerequisiteMapping.prereq_module_id_uni.in_(previous_modules)
+        ).desc(),  # Modules with previous modules as prerequisites on top
+        Module.module_id,  # Stable order, so pages do not overlap
+    )
+    return query.group_by(
+        Module.module_id, Organisation.name, department.name, school.name
+    )
+
+
+def random_filters(topics, module_ids):
+    """A random filter combination in the form produced by routes.extract_query_params."""
+    return (
+        tuple(rng.sample(sorted(school_mapper), rng.randint(0, 2))),
+        rng.choice(["", *study_level_mapper]),
+        rng.choice([None, 0, 5]),
+        rng.choice([None, 30, 10]),
+        rng.choice([None, 0, 1]),
+        rng.choice([None, 3, 2]),
+        tuple(rng.sample(sorted(language_mapper), rng.randint(0, 2))),
+        tuple(rng.sample(sorted(department_mapper), rng.randint(0, 2))),
+        tuple(rng.sample(module_ids, min(len(module_ids), rng.randint(0, 6)))),
+        tuple(rng.sample(topics, min(len(topics), rng.randint(0, 30)))),
+        tuple(rng.sample(topics, min(len(topics), rng.randint(0, 5)))),
+    )
+
+
+def run(query_function, session, filters):
+    rows = query_function(session, *filters, MODULE_FIELDS).all()
+    # group_concat does not guarantee an order within the lists
+    return [
+        {
+            **module,
+            "topics": sorted(module["topics"]),
+            "prereqModules": sorted(module["prereqModules"]),
+        }
+        for module in (module_dict(row) for row in rows)
+    ]
+
+
+def sample_inputs(session):
+    topics = [row[0] for row in session.query(Topic.topic).distinct()]
+    module_ids = [row[0] for row in session.query(Module.module_id_uni)]
+    return topics, module_ids
+
+
+def intended_order(session, filters, modules):
+    """Sorts the module dicts of the reference query by the true match counts."""
+    previous_modules, topics_of_interest = filters[8], filters[9]
+    module_ids = dict(session.query(Module.module_id_uni, Module.module_id))
+    matching_topics = dict(
+        session.query(
+            ModuleTopicMapping.module_id,
+            func.count(distinct(ModuleTopicMapping.topic_id)),
+        )
+        .join(Topic, ModuleTopicMapping.topic_id == Topic.topic_id)
+        .filter(Topic.topic.in_(topics_of_interest))
+        .group_by(ModuleTopicMapping.module_id)
+    )
+    matching_prerequisites = dict(
+        session.query(
+            ModulePrerequisiteMapping.module_id_uni,
+            func.count(distinct(ModulePrerequisiteMapping.prereq_module_id_uni)),
+        )
+        .filter(ModulePrerequisiteMapping.prereq_module_id_uni.in_(previous_modules))
+        .group_by(ModulePrerequisiteMapping.module_id_uni)
+    )
+    return sorted(
+        modules,
+        key=lambda module: (
+            -matching_topics.get(module_ids[module["id"]], 0),
+            -matching_prerequisites.get(module["id"], 0),
+            module_ids[module["id"]],
+        ),
+    )
+
+
+def check_equivalence(session, combinations, query_functions, check_catalog=False):
+    mismatches = 0
+    for filters in combinations:
+        expected = intended_order(
+            session, filters, run(legacy_filtered_modules_query, session, filters)
+        )
+        actual = {
+            query_function.__name__: run(query_function, session, filters)
+            for query_function in query_functions
+        }
+        if check_catalog:
+            catalog, positions = filter_catalog(*filters)
+            actual["module catalog"] = [
+                {"id": catalog.module_id_uni[position]}
+                for position in positions.tolist()
+            ]
+        for name, modules in actual.items():
+            if [module["id"] for module in modules] != [
+                module["id"] for module in expected
+            ] or (name != "module catalog" and modules != expected):
+                mismatches += 1
+                print(f"Mismatch of {name} for {filters}")
+                print(f"  expected {[module['id'] for module in expected][:10]}")
+                print(f"  actual   {[module['id'] for module in modules][:10]}")
+    print(
+        f"{len(combinations) * len(actual) - mismatches}/{len(combinations) * len(actual)}"
+        " filter combinations match"
+    )
+    return mismatches
+
+
+def benchmark(session, combinations, label):
+    for query_function in (legacy_filtered_modules_query, filtered_modules_query):
+        latencies = []
+        for filters in combinations:
+            start = time.perf_counter()
+            query_function(session, *filters, MODULE_FIELDS).all()
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{label:<10} {query_function.__name__:<32} "
+            f"p50 {float(np.percentile(latencies, 50)):8.2f} ms  "
+            f"p99 {float(np.percentile(latencies, 99)):8.2f} ms"
+        )
+
+
+def enlarge(path, topic_ids, module_ids):
+    """Adds topic and prerequisite mappings until every module has many of both."""
+    connection = sqlite3.connect(path)
+    with connection:
+        for module_id, module_id_uni in connection.execute(
+            "SELECT module_id, module_id_uni FROM modules"
+        ).fetchall():
+            connection.executemany(
+                "INSERT OR IGNORE INTO module_topic_mappings (module_id, topic_id) "
+                "VALUES (?, ?)",
+                [
+                    (module_id, topic_id)
+                    for topic_id in rng.sample(
+                        topic_ids, min(len(topic_ids), MANY_TOPICS)
+                    )
+                ],
+            )
+            connection.executemany(
+                "INSERT INTO module_prerequisite_mappings "
+                "(module_id_uni, prereq_module_id_uni, extracted_module_identifier_id) "
+                "VALUES (?, ?, ?)",
+                [
+                    (module_id_uni, prereq_module_id_uni, -1 - position)
+                    for position, prereq_module_id_uni in enumerate(
+                        rng.sample(module_ids, min(len(module_ids), MANY_PREREQUISITES))
+                    )
+                ],
+            )
+    connection.close()
+
+
+with Session() as session:
+    topics, module_ids = sample_inputs(session)
+    combinations = [random_filters(topics, module_ids) for _ in range(N_COMBINATIONS)]
+    # module_serving and the catalog are read from the configured database only
+    if not module_serving_available():
+        build_module_serving()
+        module_serving_available.cache_clear()
+    mismatches = check_equivalence(
+        session,
+        combinations,
+        (filtered_modules_query, serving_modules_query),
+        check_catalog=True,
+    )
+    benchmark(session, combinations[:N_TIMED], "database")
+    topic_ids = [row[0] for row in session.query(Topic.topic_id)]
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "modules.db")
+    shutil.copyfile(os.getenv("DB_PATH"), path)
+    enlarge(path, topic_ids, module_ids)
+    engine = create_engine(f"sqlite:///{path}")
+    with sessionmaker(bind=engine)() as session:
+        mismatches += check_equivalence(
+            session, combinations[:N_TIMED], (filtered_modules_query,)
+        )
+        benchmark(session, combinations[:N_TIMED], "enlarged")
+    engine.dispose()
+
+sys.exit(1 if mismatches else 0)
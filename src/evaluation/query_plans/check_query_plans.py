@@ -0,0 +1,303 @@
+# Query plan regression check for the queries of backend/module_filter.py and
+# backend/routes.py. Every scenario below is run against a copy of the configured database
+# while all SQL statements are recorded, then each statement is explained with
+# EXPLAIN QUERY PLAN. A full table scan of a large table fails the check unless the
+# scenario documents it as intended, so a schema edit cannot silently put a scan back into
+# the hot path. Intended scans are only accepted for the outermost loop of a statement (e.g.
+# listing modules with non-selective filters), never inside subqueries or joined lookups.
+# Exits with status 1 on any unexpected scan or statement that cannot be explained, except
+# for statements on tables of migrations that were not applied. Covering-index scans count
+# as full scans too, they read every row of the index. The check is not wired into CI, run
+# it by hand after schema, migration or query changes.
+#
+#   python check_query_plans.py             check the database as it is
+#   python check_query_plans.py --migrate   apply pending migrations to the copy first
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+    description="Fails on full table scans of large tables in the backend queries"
+)
+parser.add_argument(
+    "--migrate",
+    action="store_true",
+    help="apply pending migrations from resources/migrations to the copy first",
+)
+args = parser.parse_args()
+
+# The scenarios write (e.g. user_input), so they run on a copy
+directory = tempfile.mkdtemp()
+database_path = os.path.join(directory, "modules.db")
+shutil.copyfile(os.getenv("DB_PATH"), database_path)
+os.environ["DB_PATH"] = database_path
+os.environ["WARM_UP_ON_START"] = "0"
+os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(directory, "embedding_cache.db")
+
+from sqlalchemy import event, literal
+
+from backend import routes
+from backend.db_models import Session, Module, Topic, engine
+from backend.migrations import apply_migrations
+from backend.module_filter import (
+    MODULE_FIELDS,
+    MODULE_PROJECTIONS,
+    filtered_modules_query,
+    module_catalog,
+    modules_by_id,
+    serving_modules_query,
+)
+from backend.module_serving import build_module_serving, module_serving_available
+from backend.query_history import flush_filter_log, replay_query_history
+
+# Tables that grow with the module catalog. Scans of the small organisations table are fine.
+LARGE_TABLES = {
+    "modules",
+    "topics",
+    "module_topic_mappings",
+    "module_prerequisite_mappings",
+    "module_serving",
+}
+# Tables created by migrations, missing without --migrate on a database built before them
+MIGRATION_TABLES = {"filter_queries", "module_summaries"}
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX .*)?$")
+ALIAS = re.compile(r"\b(\w+) AS (\w+)\b")
+
+if args.migrate:
+    print(f"Applied migrations: {apply_migrations(database_path) or 'none'}")
+if not module_serving_available():
+    build_module_serving()
+    module_serving_available.cache_clear()
+
+statements = []
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    # Batched statements share one plan, the first parameter set explains it
+    statements.append((statement, parameters[0] if executemany else parameters))
+
+
+with Session() as session:
+    topics = [row[0] for row in session.query(Topic.topic).limit(40)]
+    module_ids = [row[0] for row in session.query(Module.module_id_uni).limit(10)]
+
+# (filters as passed to apply_filters, without fields)
+FILTERS = {
+    "defaults": ((), "", 0, 30, 0, 3, (), (), (), (), ()),
+    "school and level": (
+        ("Computation, Information and Technology",),
+        "Master",
+        0,
+        30,
+        0,
+        3,
+        ("English",),
+        (),
+        (),
+        (),
+        (),
+    ),
+    "department": ((), "", 0, 30, 0, 3, (), ("Department Mathematics",), (), (), ()),
+    "topics and previous modules": (
+        (),
+        "Bachelor",
+        0,
+        30,
+        0,
+        3,
+        (),
+        (),
+        tuple(module_ids[:5]),
+        tuple(topics[:30]),
+        tuple(topics[30:35]),
+    ),
+}
+
+
+def run_query(query_function, filters, fields=MODULE_FIELDS):
+    with Session() as session:
+        query = query_function(session, *filters, fields)
+        query.limit(5).all()
+        query.with_entities(literal(1)).order_by(None).count()
+
+
+# Listing queries walk the module table itself when the filters match most modules
+LISTING_SCANS = {
+    "modules": "listing driven by the modules table",
+    "module_serving": "listing driven by the module_serving table",
+}
+
+
+def request(path):
+    response = client.get(path)
+    assert response.status_code == 200, (path, response.status_code)
+
+
+client = routes.create_app(warm_up=False).test_client()
+
+# Startup work (index, catalogs) is not part of the request path
+routes.vectorstore.get()
+module_catalog()
+
+# (label, scenario, {table: reason} of intended full scans of the outermost loop)
+SCENARIOS = [
+    *[
+        (
+            f"apply_filters join query ({name})",
+            lambda filters=filters: run_query(filtered_modules_query, filters),
+            LISTING_SCANS,
+        )
+        for name, filters in FILTERS.items()
+    ],
+    *[
+        (
+            f"apply_filters module_serving ({name})",
+            lambda filters=filters: run_query(serving_modules_query, filters),
+            LISTING_SCANS,
+        )
+        for name, filters in FILTERS.items()
+    ],
+    (
+        "apply_filters summary projection",
+        lambda: run_query(
+            serving_modules_query, FILTERS["defaults"], MODULE_PROJECTIONS["summary"]
+        ),
+        LISTING_SCANS,
+    ),
+    ("modules_by_id", lambda: modules_by_id(tuple(module_ids)), {}),
+    ("GET /modules", lambda: request("/modules?page=2&size=5"), LISTING_SCANS),
+    (
+        "GET /modules with topics",
+        lambda: request(
+            "/modules?"
+            + "&".join(f"topicsOfInterest[]={topic}" for topic in topics[:10])
+            + f"&previousModules[]={module_ids[0]}"
+        ),
+        LISTING_SCANS,
+    ),
+    (
+        "GET /modules-by-id",
+        lambda: request(
+            "/modules-by-id?" + "&".join(f"moduleIds[]={id}" for id in module_ids)
+        ),
+        {},
+    ),
+    (
+        "GET /search-modules by id",
+        lambda: request(f"/search-modules?query={module_ids[0]}"),
+        {"modules": "substring match (LIKE '%id%') cannot use an index"},
+    ),
+    (
+        "GET /search-modules by title",
+        lambda: request("/search-modules?query=Module"),
+        {},
+    ),
+    ("store_user_input", lambda: routes.store_user_input("query plan check"), {}),
+    # Writes the filter counts the requests above buffered
+    ("filter log flush (background)", flush_filter_log, {}),
+    # Replays logged filter combinations through the listing query
+    ("query history replay (startup)", lambda: replay_query_history(), LISTING_SCANS),
+    (
+        "post_process_prefs",
+        lambda: routes.post_process_prefs(
+            {
+                "topicsOfInterest": topics[:3],
+                "topicsToExclude": topics[3:4],
+                "previousModuleIds": module_ids[:3],
+                "previousModules": [],
+                "languages": ["English"],
+            }
+        ),
+        {"modules": "fuzzy matching compares against every module title"},
+    ),
+    (
+        "module_catalog (startup)",
+        lambda: module_catalog.__wrapped__(),
+        {table: "loads the whole catalog once" for table in LARGE_TABLES},
+    ),
+]
+
+
+def resolve_tables(statement):
+    """Maps the aliases SQLAlchemy generates (modules AS modules_1) to table names."""
+    return {alias: table for table, alias in ALIAS.findall(statement)}
+
+
+def full_scans(connection, statement, parameters):
+    aliases = resolve_tables(statement)
+    plan = connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    for _, parent, _, detail in plan:
+        match = FULL_SCAN.match(detail)
+        if match:
+            table = aliases.get(match.group(1), match.group(1))
+            if table in LARGE_TABLES:
+                yield table, detail, parent == 0
+
+
+def missing_migration_table(connection, statement):
+    """The table of a pending migration that `statement` uses, if it does not exist yet."""
+    for table in MIGRATION_TABLES:
+        if (
+            re.search(rf"\b{table}\b", statement)
+            and not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table,),
+            ).fetchone()
+        ):
+            return table
+    return None
+
+
+connection = sqlite3.connect(database_path)
+failures = 0
+errors = 0
+for label, scenario, allowed_scans in SCENARIOS:
+    statements.clear()
+    scenario()
+    scans = []
+    messages = []
+    scenario_errors = 0
+    for statement, parameters in statements:
+        try:
+            scans += [
+                (table, detail, outermost and table in allowed_scans, statement)
+                for table, detail, outermost in full_scans(
+                    connection, statement, parameters
+                )
+            ]
+        except sqlite3.OperationalError as error:
+            table = missing_migration_table(connection, statement)
+            if table:
+                messages.append(f"       skipped: {table} is missing, use --migrate")
+                continue
+            # E.g. a renamed column, the statement failed in the scenario too
+            scenario_errors += 1
+            messages.append(f"       error: {error}")
+            messages.append(f"         in {' '.join(statement.split())[:200]}")
+    unexpected = [scan for scan in scans if not scan[2]]
+    status = "FAIL" if unexpected or scenario_errors else "ok"
+    print(f"{status:<4} {label} ({len(statements)} statements)")
+    for message in messages:
+        print(message)
+    for table, detail, allowed, statement in scans:
+        if allowed:
+            print(f"       allowed: {detail} - {allowed_scans[table]}")
+        else:
+            print(f"       {detail}")
+            print(f"         in {' '.join(statement.split())[:200]}")
+    failures += len(unexpected)
+    errors += scenario_errors
+
+connection.close()
+shutil.rmtree(directory, ignore_errors=True)
+print(f"{failures} unexpected full table scans, {errors} statements failed to explain")
+sys.exit(1 if failures or errors else 0)
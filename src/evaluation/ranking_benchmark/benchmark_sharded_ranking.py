@@ -0,0 +1,196 @@
+# Compares the single listwise ranking call with the sharded ranking of
+# backend/module_ranker.py (with and without the top-k refinement) on latency and quality.
+# The OpenAI client is replaced by a local mock whose latency grows with the number of
+# ranked modules (the output lists every module with its reasoning) and which orders the
+# modules by a hidden relevance plus Gaussian noise. Only the client is mocked, so every call
+# goes through the prompt building and the concurrency limit of production
+# (RANKING_MAX_CONCURRENT_CALLS, or --max-concurrent-calls); peak_calls reports the most
+# calls in flight. The noise of a call is seeded by its content (candidate list and
+# repetition), so identical calls in different modes rank identically. By default the noise
+# does not depend on the list length; --length-noise models an LLM that ranks longer lists
+# worse, which favours sharding by construction. Quality is measured as NDCG@10 and
+# recall@10 against the hidden relevance. The response cache is bypassed.
+#
+#   python benchmark_sharded_ranking.py --base-latency 0.5 --module-latency 0.08
+#
+# In the backend the sharded path only ranks more than RANKING_SHARD_SIZE candidates, e.g.
+# with RANKING_CANDIDATES=100 and PRERANK_TOP_N=100 (see backend/routes.py).
+import argparse
+import csv
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from backend import module_ranker
+from backend.module_ranker import ModuleRankings, RankedModule, rank_modules_sharded
+
+parser = argparse.ArgumentParser(
+    description="Benchmarks sharded LLM ranking against a mock LLM"
+)
+parser.add_argument(
+    "--base-latency", type=float, default=0.5, help="seconds per mock LLM call"
+)
+parser.add_argument(
+    "--module-latency",
+    type=float,
+    default=0.08,
+    help="additional seconds per ranked module",
+)
+parser.add_argument(
+    "--noise", type=float, default=0.1, help="standard deviation of the ranking noise"
+)
+parser.add_argument(
+    "--length-noise",
+    type=float,
+    default=0.0,
+    help="additional noise per module in the prompt, longer lists are ranked worse",
+)
+parser.add_argument("--candidates", type=int, nargs="+", default=[20, 50, 100])
+parser.add_argument("--shard-size", type=int, default=20)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--refine-top-k", type=int, default=10)
+parser.add_argument(
+    "--max-concurrent-calls",
+    type=int,
+    default=module_ranker.RANKING_MAX_CONCURRENT_CALLS,
+    help="ranking calls in flight at once, defaults to the backend limit",
+)
+parser.add_argument("--repetitions", type=int, default=5)
+args = parser.parse_args()
+
+K = 10
+relevance = {}
+calls = []
+calls_lock = threading.Lock()
+in_flight = {"now": 0, "peak": 0}
+MODULE_ID = re.compile(r"\('id', '(M\d+)'\)")
+
+
+def mock_parse(messages, **options):
+    """
+    Answers a ranking request built by module_ranker.ranking_messages. The student input
+    identifies the candidate list and repetition of the benchmark.
+    """
+    student_input = messages[1]["content"].removeprefix("Student input: ")
+    ids = MODULE_ID.findall(messages[-1]["content"])
+    with calls_lock:
+        calls.append(len(ids))
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+    try:
+        ranked_modules = mock_rankings(student_input, ids)
+    finally:
+        with calls_lock:
+            in_flight["now"] -= 1
+    parsed = ModuleRankings(ranked_modules=ranked_modules)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))]
+    )
+
+
+def mock_rankings(student_input, ids):
+    seed = hashlib.sha256(json.dumps([student_input, sorted(ids)]).encode()).digest()
+    call_rng = np.random.default_rng(int.from_bytes(seed[:8], "little"))
+    scale = args.noise + args.length_noise * len(ids)
+    noise = dict(zip(sorted(ids), call_rng.normal(0, scale, len(ids))))
+    noisy = [relevance[i] + noise[i] for i in ids]
+    time.sleep(args.base_latency + args.module_latency * len(ids))
+    return [
+        RankedModule(module_id=ids[position], reasoning="mock")
+        for position in np.argsort(noisy)[::-1]
+    ]
+
+
+mock_client = SimpleNamespace(
+    beta=SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(parse=mock_parse))
+    )
+)
+module_ranker.openai_client = lambda: mock_client
+module_ranker._ranking_calls = threading.BoundedSemaphore(args.max_concurrent_calls)
+module_ranker.cached_response = lambda key, compute: compute()
+
+
+def sample_modules(count, seed):
+    """Every mode ranks the same candidate lists."""
+    sample_rng = np.random.default_rng(seed)
+    relevance.clear()
+    modules = []
+    for index in range(count):
+        module_id = f"M{index:04d}"
+        relevance[module_id] = float(sample_rng.random())
+        modules.append(frozenset({("id", module_id), ("title", f"Module {index}")}))
+    # The candidates arrive pre-ranked, i.e. roughly ordered by relevance
+    return tuple(
+        sorted(
+            modules, key=lambda m: -relevance[dict(m)["id"]] + sample_rng.normal(0, 0.2)
+        )
+    )
+
+
+def ndcg_at_k(ranked_ids, k=K):
+    ideal = sorted(relevance.values(), reverse=True)[:k]
+    dcg = sum(
+        relevance[i] / math.log2(rank + 2) for rank, i in enumerate(ranked_ids[:k])
+    )
+    return dcg / sum(r / math.log2(rank + 2) for rank, r in enumerate(ideal))
+
+
+def recall_at_k(ranked_ids, k=K):
+    best = sorted(relevance, key=relevance.get, reverse=True)[:k]
+    return len(set(ranked_ids[:k]) & set(best)) / k
+
+
+def main():
+    modes = {
+        "single": dict(shard_size=math.inf),
+        "sharded": dict(shard_size=args.shard_size, max_workers=args.workers),
+        "sharded+refine": dict(
+            shard_size=args.shard_size,
+            max_workers=args.workers,
+            refine_top_k=args.refine_top_k,
+        ),
+    }
+    results = []
+    for count in args.candidates:
+        for mode, options in modes.items():
+            latencies, ndcgs, recalls = [], [], []
+            calls.clear()
+            in_flight["peak"] = 0
+            for repetition in range(args.repetitions):
+                modules = sample_modules(count, seed=repetition)
+                start = time.perf_counter()
+                ranking = rank_modules_sharded(
+                    f"{count}:{repetition}", modules, **options
+                )
+                latencies.append(time.perf_counter() - start)
+                ranked_ids = [ranked_module.module_id for ranked_module in ranking]
+                ndcgs.append(ndcg_at_k(ranked_ids))
+                recalls.append(recall_at_k(ranked_ids))
+            result = {
+                "mode": mode,
+                "candidates": count,
+                "calls": len(calls) // args.repetitions,
+                "peak_calls": in_flight["peak"],
+                "p50_s": round(float(np.percentile(latencies, 50)), 3),
+                "max_s": round(max(latencies), 3),
+                f"ndcg@{K}": round(float(np.mean(ndcgs)), 4),
+                f"recall@{K}": round(float(np.mean(recalls)), 4),
+            }
+            print(result)
+            results.append(result)
+
+    with open("sharded_ranking_benchmark.csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=results[0].keys())
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
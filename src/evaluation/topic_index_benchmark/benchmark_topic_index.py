@@ -0,0 +1,106 @@
+# Compares the topic index types (see backend/topic_index.py) on recall@k against the exact
+# flat index and on the latency of a single map_topic search. Besides the real topics table
+# the topics are enlarged synthetically (jittered copies) to estimate behaviour at larger sizes.
+# Query embeddings are precomputed, so the numbers exclude the OpenAI embeddings round trip.
+import csv
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.topic_index import (
+    TOPIC_INDEX_TYPES,
+    load_topic_embeddings,
+    make_index,
+    search_index,
+)
+from backend.topic_mapper import VectorStore
+
+load_dotenv()
+
+SCALE_FACTORS = (1, 10)
+K_VALUES = (10, 30)
+N_QUERIES = 200
+NOISE = 0.02
+THRESHOLD = 0.5
+
+rng = np.random.default_rng(42)
+
+
+def enlarge(embeddings, factor):
+    """Appends factor - 1 jittered and re-normalized copies of every embedding."""
+    if factor == 1:
+        return embeddings
+    copies = [embeddings]
+    for _ in range(factor - 1):
+        jittered = embeddings + rng.normal(0, NOISE, embeddings.shape).astype(
+            np.float32
+        )
+        jittered /= np.linalg.norm(jittered, axis=1, keepdims=True)
+        copies.append(jittered)
+    return np.concatenate(copies)
+
+
+def sample_queries(embeddings):
+    # Queries are perturbed topics, similar to a student's phrasing of an existing topic
+    rows = rng.choice(
+        len(embeddings), size=min(N_QUERIES, len(embeddings)), replace=False
+    )
+    queries = embeddings[rows] + rng.normal(0, NOISE, (len(rows), embeddings.shape[1]))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype(np.float32)
+
+
+def recall_at_k(index, exact_index, queries, k):
+    _, found = search_index(index, queries, k)
+    _, expected = exact_index.search(queries, k)
+    hits = sum(
+        len(set(found_row[found_row >= 0]) & set(expected_row))
+        for found_row, expected_row in zip(found, expected)
+    )
+    return hits / expected.size
+
+
+def map_topic_latencies(vectorstore, queries, k):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        vectorstore.search_embedding(query, k, threshold=THRESHOLD)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+def main():
+    _, topic_embeddings, _ = load_topic_embeddings()
+    results = []
+    for factor in SCALE_FACTORS:
+        embeddings = enlarge(topic_embeddings, factor)
+        queries = sample_queries(embeddings)
+        exact_index = make_index(embeddings, index_type="flat")
+        for index_type in TOPIC_INDEX_TYPES:
+            start = time.perf_counter()
+            index = make_index(embeddings, index_type=index_type)
+            build_seconds = time.perf_counter() - start
+            vectorstore = VectorStore.from_index(index)
+            for k in K_VALUES:
+                p50, p99 = map_topic_latencies(vectorstore, queries, k)
+                result = {
+                    "index_type": index_type,
+                    "topics": len(embeddings),
+                    "k": k,
+                    "recall": round(recall_at_k(index, exact_index, queries, k), 4),
+                    "p50_ms": round(p50, 3),
+                    "p99_ms": round(p99, 3),
+                    "build_s": round(build_seconds, 2),
+                }
+                print(result)
+                results.append(result)
+
+    with open("topic_index_benchmark.csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=results[0].keys())
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Checks that every topic index type (see backend/topic_index.py) supports the operations the
+# backend relies on: reconstructing vectors by topic id (known-topic lookup in topic_mapper,
+# 07_compute_topic_neighbors) before and after persisting, and removing or replacing topics
+# (06_update_topic_index). Runs on random vectors, no database or OpenAI access is needed.
+# Exits with status 1 if any operation fails for any index type.
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+
+from backend.topic_index import (
+    TOPIC_INDEX_TYPES,
+    index_ids,
+    load_topic_index,
+    make_index,
+    write_topic_index,
+)
+from backend.topic_mapper import VectorStore
+
+SIZE = 2000
+DIMENSION = 64
+
+rng = np.random.default_rng(42)
+
+
+def unit(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def reconstructs(index, topic_ids, expected):
+    # Inner product indexes store normalized vectors
+    vectors = np.stack([index.reconstruct(int(topic_id)) for topic_id in topic_ids])
+    return np.allclose(unit(vectors), unit(expected), atol=1e-5)
+
+
+def check(index_type, embeddings, ids):
+    """Returns the failed operations of `index_type`."""
+    failures = []
+    index = make_index(embeddings, index_type=index_type, ids=ids)
+    vectorstore = VectorStore.from_index(index, index_type=index_type)
+
+    for name, operation in [
+        ("reconstruct", lambda: reconstructs(index, ids, embeddings)),
+        (
+            "persisted reconstruct",
+            lambda: reconstructs_persisted(index, index_type, ids, embeddings),
+        ),
+        ("remove", lambda: removes(vectorstore, ids)),
+        ("replace", lambda: replaces(vectorstore, ids)),
+    ]:
+        try:
+            ok = operation()
+        except Exception as error:
+            ok = False
+            print(f"  {index_type} {name}: {type(error).__name__}: {error}")
+        if not ok:
+            failures.append(name)
+    return failures
+
+
+def reconstructs_persisted(index, index_type, ids, embeddings):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "topic_index")
+        write_topic_index(index, "0" * 64, path=path, index_type=index_type)
+        loaded, _ = load_topic_index(path, index_type=index_type)
+        return reconstructs(loaded, ids, embeddings)
+
+
+def removes(vectorstore, ids):
+    removed = ids[:10].tolist()
+    vectorstore.remove_topics(removed)
+    remaining = set(index_ids(vectorstore.index).tolist())
+    return (
+        remaining == set(ids.tolist()) - set(removed)
+        and vectorstore.index.ntotal == len(ids) - len(removed)
+        and reconstructs_all(vectorstore)
+    )
+
+
+def replaces(vectorstore, ids):
+    topic_id = int(ids[-1])
+    embedding = unit(rng.normal(size=DIMENSION)).astype(np.float32)
+    topic = SimpleNamespace(topic_id=topic_id, topic="replaced")
+    vectorstore.replace_topics([topic], embedding[None])
+    return (
+        np.allclose(unit(vectorstore.index.reconstruct(topic_id)), embedding, atol=1e-5)
+        and vectorstore.catalog.names_of([topic_id]) == ["replaced"]
+        and reconstructs_all(vectorstore)
+    )
+
+
+def reconstructs_all(vectorstore):
+    for topic_id in index_ids(vectorstore.index).tolist():
+        vectorstore.index.reconstruct(topic_id)
+    return True
+
+
+def main():
+    embeddings = unit(rng.normal(size=(SIZE, DIMENSION))).astype(np.float32)
+    # Sparse ids like the topics table after removals
+    ids = np.sort(rng.choice(10 * SIZE, SIZE, replace=False)).astype(np.int64)
+    failed = 0
+    for index_type in TOPIC_INDEX_TYPES:
+        failures = check(index_type, embeddings, ids)
+        print(f"{'FAIL' if failures else 'ok  '} {index_type} {', '.join(failures)}")
+        failed += bool(failures)
+    print(f"{failed} of {len(TOPIC_INDEX_TYPES)} index types failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 #!/bin/bash
 # These Scripts build the database
+# Scripts import from the backend package, which lives one directory up
+export PYTHONPATH="$(cd .. && pwd)${PYTHONPATH:+:$PYTHONPATH}"
+
 # Step 1: Run 00_build_db.py first
 python3 00_build_db.py
+# Records the migrations, the built schema already contains their indexes
+python3 run_migrations.py
 
 # Step 2: Run all 01_*.py scripts concurrently
 python3 01_create_topic_embeddings.py &
@@ -14,3 +19,8 @@ wait
 python3 02_label_organisations.py
 python3 03_extract_module_prerequisite_identifiers.py
 python3 04_map_module_prerequisites.py
+python3 05_build_topic_index.py
+python3 07_compute_topic_neighbors.py
+python3 08_build_module_serving.py
+python3 09_embed_modules.py
+python3 10_summarize_modules.py
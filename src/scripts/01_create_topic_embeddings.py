@@ -1,15 +1,20 @@
 # This creates the topic embeddings which are used to find similar topics
-import json
 import sqlite3
 
 from dotenv import load_dotenv
-from openai import OpenAI
 import os
 
 load_dotenv()
 # Change to the appropriate directory
 os.chdir("../../")
 resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+# Topics go through the persistent embedding cache, so rebuilding the database does not
+# re-embed known topics and the backend finds them cached when students query them
+from backend.embeddings import cached_embed_texts, embedding_cache, pack_embedding
 
 # Create a new database and execute the DDL script
 modules_con = sqlite3.connect(os.path.join(resources_path, "modules.db"))
@@ -21,18 +26,15 @@ topic_rows = modules_con.execute(
 topics = [topic_row[1] for topic_row in topic_rows]
 batch_size = 2000
 cursor = modules_con.cursor()
-client = OpenAI()
 # Loop through topics in batches
 for i in range(0, len(topics), batch_size):
     print(f"Processing batch {i // batch_size + 1}")
     batch_topics = topics[i : i + batch_size]
-    response = client.embeddings.create(
-        model="text-embedding-ada-002", input=batch_topics
-    )
+    batch_embeddings = cached_embed_texts(batch_topics)
     topics_with_embeddings = []
-    for j, data in enumerate(response.data):
+    for j, batch_embedding in enumerate(batch_embeddings):
         topic_id = topic_rows[i + j][0]
-        embedding = json.dumps(data.embedding)
+        embedding = pack_embedding(batch_embedding)
         topics_with_embeddings.append((embedding, topic_id))
 
     # Insert data into the database in chunks to avoid memory issues
@@ -45,3 +47,5 @@ for i in range(0, len(topics), batch_size):
 
     # Commit and clear the list to free memory
     modules_con.commit()
+
+print(embedding_cache().stats())
@@ -0,0 +1,20 @@
+# Builds the faiss index over all topic embeddings and persists it next to the database.
+# The backend memory-maps this file instead of building the index on every start.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.topic_index import (
+    TOPIC_INDEX_PATH,
+    build_topic_index,
+    write_topic_index,
+)
+
+index, checksum = build_topic_index()
+write_topic_index(index, checksum)
+print(f"Wrote {index.ntotal} topics to {TOPIC_INDEX_PATH} (checksum {checksum[:16]})")
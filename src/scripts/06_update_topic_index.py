@@ -0,0 +1,82 @@
+# Adds, replaces or removes single topics in the topics table and the persisted topic index
+# without re-embedding all topics or rebuilding the index. Running servers map the new index
+# version on their next reload check (TOPIC_INDEX_RELOAD_INTERVAL). Renaming or removing
+# topics also rebuilds module_serving, so the module listings show the new topic lists.
+#   python3 06_update_topic_index.py add "Quantum Computing" "Federated Learning"
+#   python3 06_update_topic_index.py replace 1234 "Machine Learning"
+#   python3 06_update_topic_index.py remove 1234 1235
+import argparse
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.db_models import Session, Topic, ModuleTopicMapping
+from backend.embeddings import cached_embed_texts, pack_embedding
+from backend.module_serving import build_module_serving
+from backend.topic_index import topics_checksum
+from backend.topic_mapper import VectorStore
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Add new topics")
+    add.add_argument("topics", nargs="+")
+    replace = commands.add_parser("replace", help="Rename and re-embed a topic")
+    replace.add_argument("topic_id", type=int)
+    replace.add_argument("topic")
+    remove = commands.add_parser(
+        "remove", help="Remove topics and their module mappings"
+    )
+    remove.add_argument("topic_ids", nargs="+", type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Load the index before the topics table changes, otherwise it would be rebuilt
+    vectorstore = VectorStore()
+
+    # The index copy is changed before the database commit, if it fails (e.g. a
+    # duplicate topic) the session rolls back and neither the table nor the index changes
+    with Session() as session:
+        if args.command == "add":
+            embeddings = cached_embed_texts(args.topics)
+            topics = [
+                Topic(topic=topic, embedding=pack_embedding(embedding))
+                for topic, embedding in zip(args.topics, embeddings)
+            ]
+            session.add_all(topics)
+            # Assigns the topic ids
+            session.flush()
+            vectorstore.add_topics(topics, embeddings)
+        elif args.command == "replace":
+            embeddings = cached_embed_texts([args.topic])
+            topic = session.get(Topic, args.topic_id)
+            if topic is None:
+                raise SystemExit(f"Topic {args.topic_id} does not exist")
+            topic.topic = args.topic
+            topic.embedding = pack_embedding(embeddings[0])
+            vectorstore.replace_topics([topic], embeddings)
+        else:
+            session.query(ModuleTopicMapping).filter(
+                ModuleTopicMapping.topic_id.in_(args.topic_ids)
+            ).delete()
+            session.query(Topic).filter(Topic.topic_id.in_(args.topic_ids)).delete()
+            vectorstore.remove_topics(args.topic_ids)
+        session.commit()
+
+    vectorstore.save(topics_checksum())
+    print(f"Topic index now contains {vectorstore.index.ntotal} topics")
+    if args.command != "add":
+        # New topics are not mapped to modules yet, the others change the topics column
+        print(f"Wrote {build_module_serving()} modules to module_serving")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# Precomputes the nearest neighbours of every topic from the persisted topic index.
+# Mapping a topic that is already in the topics table then needs neither an embeddings
+# request nor an index search. Rerun after 05/06, stale neighbours are ignored.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.topic_index import load_or_build_topic_index
+from backend.topic_neighbors import (
+    TOPIC_NEIGHBORS_PATH,
+    compute_topic_neighbors,
+    write_topic_neighbors,
+)
+
+index, checksum = load_or_build_topic_index()
+table = compute_topic_neighbors(index)
+write_topic_neighbors(table, checksum)
+print(
+    f"Wrote {table['neighbor_ids'].shape[1]} neighbours of {len(table)} topics "
+    f"to {TOPIC_NEIGHBORS_PATH} (checksum {checksum[:16]})"
+)
@@ -0,0 +1,16 @@
+# Writes the denormalized module_serving table: one row per module with organisation
+# names and ids, topics and prerequisites already joined and aggregated. The backend
+# serves module listings from it instead of joining six tables per request.
+# Rerun whenever modules, topics, organisations or prerequisite mappings change.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.module_serving import build_module_serving
+
+print(f"Wrote {build_module_serving()} modules to module_serving")
@@ -0,0 +1,35 @@
+# Embeds the title and description of every module that the filters can return. The
+# backend pre-ranks the candidates of /modules-ranked by their similarity to the student
+# text and only sends the closest ones to the LLM. Rerun after the modules changed, stale
+# vectors are ignored.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.embeddings import embedding_cache
+from backend.module_catalog import ModuleCatalog
+from backend.module_vectors import (
+    MODULE_VECTORS_PATH,
+    compute_module_vectors,
+    module_texts,
+    module_texts_checksum,
+    write_module_vectors,
+)
+
+catalog = ModuleCatalog.load()
+texts = module_texts(catalog)
+vectors = compute_module_vectors(texts)
+if vectors is None:
+    raise SystemExit("No modules to embed")
+checksum = module_texts_checksum(catalog.module_id_uni, texts)
+write_module_vectors(catalog.module_id_uni, vectors, checksum)
+print(
+    f"Wrote {len(vectors)} module vectors to {MODULE_VECTORS_PATH} "
+    f"(checksum {checksum[:16]})"
+)
+print(embedding_cache().stats())
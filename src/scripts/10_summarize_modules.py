@@ -0,0 +1,22 @@
+# Writes a compact ranking summary of every module to module_summaries: at most
+# SUMMARY_MAX_TOKENS tokens on what the module teaches and what it requires, generated from
+# the description and prerequisites. The ranking prompt uses it instead of the raw texts.
+# Only modules whose texts changed since their summary (see the content hash) are sent to
+# the LLM again, so rerunning after an import is cheap. Needs the module_summaries table,
+# apply the migrations with run_migrations.py first.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.module_summaries import SUMMARY_MAX_TOKENS, build_module_summaries
+
+written, unchanged, failed = build_module_summaries()
+print(
+    f"Wrote {written} module summaries of at most {SUMMARY_MAX_TOKENS} tokens, "
+    f"{unchanged} were up to date, {failed} failed (see the log, rerun to retry)"
+)
@@ -0,0 +1,33 @@
+# Converts topic embeddings that were stored as JSON text into the packed float32 format
+# (see backend/embeddings.py). Rows that are already packed are left untouched.
+import os
+import sqlite3
+
+from backend.embeddings import pack_embedding, unpack_embedding
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+
+modules_con = sqlite3.connect(os.path.join(resources_path, "modules.db"))
+
+topic_rows = modules_con.execute(
+    "SELECT topic_id, embedding FROM topics WHERE typeof(embedding) = 'text'"
+).fetchall()
+print(f"Converting {len(topic_rows)} JSON embeddings")
+
+batch_size = 2000
+for i in range(0, len(topic_rows), batch_size):
+    batch = topic_rows[i : i + batch_size]
+    modules_con.executemany(
+        "UPDATE topics SET embedding = ? WHERE topic_id = ?",
+        [
+            (pack_embedding(unpack_embedding(embedding)), topic_id)
+            for topic_id, embedding in batch
+        ],
+    )
+    modules_con.commit()
+
+# Give the space of the JSON strings back to the file system
+modules_con.execute("VACUUM")
+modules_con.close()
@@ -0,0 +1,16 @@
+# Applies the SQL migrations in resources/migrations to an existing database, e.g. the
+# covering indexes added after the database was built. Databases built from modules.dbml
+# already contain them, the migrations are then only recorded as applied.
+import os
+
+# Change to the appropriate directory
+os.chdir("../../")
+resources_path = "resources"
+os.environ.setdefault(
+    "DB_PATH", os.path.abspath(os.path.join(resources_path, "modules.db"))
+)
+
+from backend.migrations import apply_migrations
+
+applied = apply_migrations()
+print(f"Applied {len(applied)} migrations: {', '.join(applied) or 'none'}")